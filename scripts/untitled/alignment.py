@@ -0,0 +1,111 @@
+import os
+import scripts.untitled.operators as opr
+
+#Per-key plan for every secondary model, built once from the safetensors headers before the merge starts.
+#Renamed and reshaped keys are loaded through LoadAligned. Keys that are missing, or whose shape differs in a
+#way that can't be aligned, fall back to model_a and are listed in the report.
+
+PRESENT = 'present'
+RENAMED = 'renamed'
+RESHAPED = 'reshaped'
+MISSING = 'missing'
+MISMATCHED = 'mismatched'
+
+#Prefixes that differ between otherwise identical layouts, e.g. bare vs ldm-prefixed transformers or old SD1 text encoders
+ALIAS_PREFIXES = (
+    'model.diffusion_model.',
+    'cond_stage_model.transformer.text_model.',
+    'cond_stage_model.transformer.'
+)
+
+def canonical(key) -> str:
+    for prefix in ALIAS_PREFIXES:
+        if key.startswith(prefix):
+            return key[len(prefix):]
+    return key
+
+
+def conform_kind(key,source_shape,shape) -> str|None:
+    #The only shape differences that are aligned: 1x1 convs vs linear layers, and embeddings
+    #grown or shrunk along the leading dim (vocab, positions). None for anything else
+    if tuple(d for d in source_shape if d != 1) == tuple(d for d in shape if d != 1):
+        return 'reshaped'
+    if 'embedding' in key and len(source_shape) == len(shape) and source_shape[1:] == shape[1:]:
+        return 'padded' if source_shape[0] < shape[0] else 'cropped'
+    return None
+
+
+class Alignment:
+    def __init__(self,primary,headers):
+        #headers: {checkpoint: {key: header entry}}, only entries that are not PRESENT are stored
+        self.primary = primary
+        self.plans = {}
+        self.fallback = set() #Keys taken from model_a: missing or mismatched in a secondary model
+        self.reshaped = {} #checkpoint: [(kind, key, source shape, shape)]
+        self.mismatched = {} #checkpoint: [(key, source shape, shape)]
+        target = headers[primary]
+
+        for checkpoint,header in headers.items():
+            if checkpoint == primary: continue
+            plan = {}
+            aliases = None
+            for key,entry in target.items():
+                source_key = key
+                if key not in header:
+                    if aliases is None:
+                        aliases = {canonical(k): k for k in header}
+                    source_key = aliases.get(canonical(key))
+
+                shape = tuple(entry['shape'])
+                if source_key is None:
+                    plan[key] = (MISSING,None,shape)
+                    self.fallback.add(key)
+                    continue
+                source_shape = tuple(header[source_key]['shape'])
+                if source_shape != shape:
+                    kind = conform_kind(key,source_shape,shape)
+                    if kind is None:
+                        plan[key] = (MISMATCHED,source_key,shape)
+                        self.fallback.add(key)
+                        self.mismatched.setdefault(checkpoint,[]).append((key,source_shape,shape))
+                    else:
+                        plan[key] = (RESHAPED,source_key,shape)
+                        self.reshaped.setdefault(checkpoint,[]).append((kind,key,source_shape,shape))
+                elif source_key != key:
+                    plan[key] = (RENAMED,source_key,shape)
+            self.plans[checkpoint] = plan
+
+    def __bool__(self):
+        return any(self.plans.values())
+
+    def affects(self,key) -> bool:
+        return any(key in plan for plan in self.plans.values())
+
+    def rewrite(self,operation) -> opr.Operation:
+        #Swaps loads from secondary models for aligned loads, untouched branches keep their interned nodes
+        if isinstance(operation,opr.LoadTensor):
+            status, source_key, shape = self.plans.get(operation.alpha,{}).get(operation.key,(PRESENT,None,None))
+            if status in (RENAMED,RESHAPED):
+                return opr.LoadAligned(operation.key,operation.alpha,source_key,shape)
+            return operation
+
+        sources = tuple(self.rewrite(source) for source in operation.sources)
+        if all(new is old for new,old in zip(sources,operation.sources)):
+            return operation
+        return operation.replace_sources(*sources)
+
+    def report(self,progress,keys):
+        #keys: the keys that get a merge task, alignment of anything else doesn't affect the merge
+        for checkpoint,plan in self.plans.items():
+            statuses = [status for key,(status,_,_) in plan.items() if key in keys]
+            if not statuses: continue
+            progress('Alignment of '+os.path.basename(checkpoint)+':')
+            for status in (RENAMED,RESHAPED,MISSING,MISMATCHED):
+                if status in statuses:
+                    progress(status.title(),v=statuses.count(status))
+            for kind,key,source_shape,shape in self.reshaped.get(checkpoint,()):
+                if key in keys:
+                    progress(kind.title()+' '+key,v=f'{list(source_shape)} -> {list(shape)}')
+            for key,source_shape,shape in self.mismatched.get(checkpoint,()):
+                if key in keys:
+                    progress('Mismatched '+key,v=f'{list(source_shape)} vs {list(shape)}, using model_a')
@@ -0,0 +1,411 @@
+import os,json,struct,math,mmap,threading,concurrent.futures,torch
+from collections import OrderedDict
+from safetensors.torch import safe_open
+from safetensors import SafetensorError
+
+ARCHITECTURES_LIST = []
+
+SD_SKIP_KEYS = frozenset([
+    "alphas_cumprod",
+    "alphas_cumprod_prev",
+    "betas",
+    "log_one_minus_alphas_cumprod",
+    "posterior_log_variance_clipped",
+    "posterior_mean_coef1",
+    "posterior_mean_coef2",
+    "posterior_variance",
+    "sqrt_alphas_cumprod",
+    "sqrt_one_minus_alphas_cumprod",
+    "sqrt_recip_alphas_cumprod",
+    "sqrt_recipm1_alphas_cumprod"
+])
+
+SD_SELECTORS = {
+    "clip": "cond.*",
+    "base": "cond.*",
+    "model_ema":  "model_ema.*",
+    "unet": "model\\.diffusion_model.*",
+    "in":   "model\\.diffusion_model\\.input_blocks.*",
+    "out":  "model\\.diffusion_model\\.output_blocks.*",
+    "mid":  "model\\.diffusion_model\\.middle_block.*"
+}
+
+#Transformer checkpoints are found both with and without the ldm prefix
+DM = "(?:model\\.diffusion_model\\.)?"
+
+
+class Architecture:
+    name = 'Unknown'
+    detect_keys = () #All must be present
+    selectors = SD_SELECTORS
+    skip_keys = SD_SKIP_KEYS #Always loaded from the primary model
+    skip_substrings = ('model_ema','first_stage_model')
+
+    def identify(header) -> str:
+        return None
+
+    @classmethod
+    def is_skipped(cls, key) -> bool:
+        return key in cls.skip_keys or any(substring in key for substring in cls.skip_substrings)
+
+
+class SD1(Architecture):
+    name = 'v1'
+    detect_keys = ('cond_stage_model.transformer.text_model.embeddings.token_embedding.weight',)
+
+    def identify(header):
+        channels = header['model.diffusion_model.input_blocks.0.0.weight']['shape'][1]
+        if channels == 9: return 'v1-inpainting'
+        if channels == 8: return 'v1-instruct-pix2pix'
+        return 'v1'
+
+ARCHITECTURES_LIST.append(SD1)
+
+
+class SDXL(Architecture):
+    name = 'SDXL'
+    detect_keys = ('conditioner.embedders.0.transformer.text_model.embeddings.token_embedding.weight',)
+    selectors = SD_SELECTORS | {
+        "clip_l": "conditioner\\.embedders\\.0.*",
+        "clip_g": "conditioner\\.embedders\\.1.*"
+    }
+
+    def identify(header):
+        return 'SDXL' if 'conditioner.embedders.1.model.ln_final.weight' in header else 'SDXL-refiner'
+
+ARCHITECTURES_LIST.append(SDXL)
+
+
+class SD2(Architecture):
+    name = 'v2'
+    detect_keys = ('cond_stage_model.model.token_embedding.weight',)
+
+    def identify(header):
+        channels = header['model.diffusion_model.input_blocks.0.0.weight']['shape'][1]
+        return 'v2-inpainting' if channels == 9 else 'v2'
+
+ARCHITECTURES_LIST.append(SD2)
+
+
+class SD3(Architecture):
+    name = 'SD3'
+    detect_keys = ('joint_blocks.0.context_block.attn.qkv.weight',)
+    selectors = {
+        "clip": "text_encoders\\.clip_[lg].*",
+        "t5": "text_encoders\\.t5xxl.*",
+        "base": "text_encoders.*",
+        "unet": DM+"(?:joint_blocks|x_embedder|context_embedder|t_embedder|y_embedder|final_layer|pos_embed).*",
+        "joint": DM+"joint_blocks.*"
+    }
+    skip_keys = frozenset()
+    skip_substrings = ('first_stage_model',)
+
+ARCHITECTURES_LIST.append(SD3)
+
+
+class Flux(Architecture):
+    name = 'Flux'
+    detect_keys = ('double_blocks.0.img_attn.qkv.weight',)
+    selectors = {
+        "clip": "text_encoders\\.clip_l.*",
+        "t5": "text_encoders\\.t5xxl.*",
+        "base": "text_encoders.*",
+        "unet": DM+"(?:double_blocks|single_blocks|img_in|txt_in|time_in|vector_in|guidance_in|final_layer).*",
+        "double": DM+"double_blocks.*",
+        "single": DM+"single_blocks.*"
+    }
+    skip_keys = frozenset()
+    skip_substrings = ('first_stage_model','vae.')
+
+ARCHITECTURES_LIST.append(Flux)
+
+
+class FluxDiffusers(Architecture):
+    name = 'Flux-diffusers'
+    detect_keys = ('single_transformer_blocks.0.attn.to_q.weight','transformer_blocks.0.attn.add_q_proj.weight')
+    selectors = {
+        "unet": ".*",
+        "double": "transformer_blocks.*",
+        "single": "single_transformer_blocks.*"
+    }
+    skip_keys = frozenset()
+    skip_substrings = ()
+
+ARCHITECTURES_LIST.append(FluxDiffusers)
+
+
+class SD3Diffusers(Architecture):
+    name = 'SD3-diffusers'
+    detect_keys = ('transformer_blocks.0.attn.add_q_proj.weight','context_embedder.weight')
+    selectors = {
+        "unet": ".*",
+        "joint": "transformer_blocks.*"
+    }
+    skip_keys = frozenset()
+    skip_substrings = ()
+
+ARCHITECTURES_LIST.append(SD3Diffusers)
+
+
+class UNetDiffusers(Architecture):
+    name = 'UNet-diffusers'
+    detect_keys = ('down_blocks.0.resnets.0.conv1.weight',)
+    selectors = {
+        "unet": ".*",
+        "in": "down_blocks.*",
+        "out": "up_blocks.*",
+        "mid": "mid_block.*"
+    }
+    skip_keys = frozenset()
+    skip_substrings = ()
+
+ARCHITECTURES_LIST.append(UNetDiffusers)
+
+
+def detect(keys) -> type[Architecture]:
+    #Detection keys are matched with and without the ldm diffusion_model prefix
+    keys = set(keys)
+    for arch in ARCHITECTURES_LIST:
+        if all(key in keys or 'model.diffusion_model.'+key in keys for key in arch.detect_keys):
+            return arch
+    return Architecture
+
+
+def identify(header) -> tuple[str,type[Architecture]]:
+    arch = detect(header)
+    return arch.identify(header) or arch.name, arch
+
+
+### HEADERS
+DTYPE_SIZES = {'F64':8,'I64':8,'F32':4,'I32':4,'F16':2,'BF16':2,'I16':2,'F8_E4M3':1,'F8_E5M2':1,'I8':1,'U8':1,'BOOL':1}
+
+def entry_nbytes(entry) -> int:
+    return math.prod(entry['shape']) * DTYPE_SIZES.get(entry['dtype'],4)
+
+def read_header(filename) -> dict:
+    #{key: {'dtype','shape','data_offsets','file','start'}} straight from the safetensors headers, no tensor data is read
+    return read_header_metadata(filename)[0]
+
+
+def read_header_metadata(filename) -> tuple[dict,dict]:
+    if is_sharded(filename):
+        with open(filename,'r') as file:
+            index = json.load(file)
+        header = {}
+        metadata = {str(k): str(v) for k,v in index.get('metadata',{}).items()}
+        for shard in set(index['weight_map'].values()):
+            shard_header, shard_metadata = read_header_metadata(os.path.join(os.path.dirname(filename),shard))
+            header.update(shard_header)
+            metadata.update(shard_metadata)
+        return header, metadata
+
+    with open(filename,'rb') as file:
+        length = struct.unpack('<Q',file.read(8))[0]
+        header = json.loads(file.read(length))
+    metadata = header.pop('__metadata__',None) or {}
+    for entry in header.values():
+        entry['file'] = filename
+        entry['start'] = 8 + length
+    return header, metadata
+
+
+### PROBING
+#Everything the merger and the UI need to know about a checkpoint comes from one header read, cached by file identity
+DTYPE_NAMES = {'F64':'float64','F32':'float32','F16':'float16','BF16':'bfloat16','F8_E4M3':'float8_e4m3fn','F8_E5M2':'float8_e5m2',
+               'I64':'int64','I32':'int32','I16':'int16','I8':'int8','U8':'uint8','BOOL':'bool'}
+DTYPE_KEY = 'model.diffusion_model.input_blocks.0.0.weight'
+
+PROBE_CACHE_SIZE = 16
+probes = OrderedDict() #file identity: Probe, least recently used first
+probes_lock = threading.Lock()
+
+class Probe:
+    __slots__ = ('filename','header','metadata','name','arch','dtype')
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.header, self.metadata = read_header_metadata(filename)
+        self.name, self.arch = identify(self.header)
+        entry = self.header.get(DTYPE_KEY) or next(iter(self.header.values()),{})
+        self.dtype = DTYPE_NAMES.get(entry.get('dtype'))
+
+    def keys(self) -> list:
+        return list(self.header)
+
+
+def file_identity(filename) -> tuple:
+    stat = os.stat(filename)
+    return (os.path.abspath(filename),stat.st_size,stat.st_mtime_ns)
+
+
+def probe(filename) -> Probe:
+    identity = file_identity(filename)
+    with probes_lock:
+        result = probes.get(identity)
+        if result is not None:
+            probes.move_to_end(identity)
+            return result
+    result = Probe(filename)
+    with probes_lock:
+        for stale in [key for key in probes if key[0] == identity[0]]: #Earlier versions of the same file
+            del probes[stale]
+        probes[identity] = result
+        while len(probes) > PROBE_CACHE_SIZE:
+            probes.popitem(last=False)
+    return result
+
+
+def probe_all(filenames) -> dict:
+    #Probes every model slot concurrently, empty slots are skipped
+    filenames = list(dict.fromkeys(filter(None,filenames)))
+    if not filenames: return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(filenames)) as executor:
+        return dict(zip(filenames,executor.map(probe,filenames)))
+
+
+### SHARDED CHECKPOINTS
+def is_sharded(filename) -> bool:
+    return filename.endswith('.index.json')
+
+
+class ShardedSafeOpen:
+    #Presents a model.safetensors.index.json checkpoint as a single safetensors file
+    def __init__(self,filename,framework='pt',device='cpu'):
+        with open(filename,'r') as file:
+            index = json.load(file)
+        directory = os.path.dirname(filename)
+        self.weight_map = {key: os.path.join(directory,shard) for key,shard in index['weight_map'].items()}
+        self.index_metadata = {str(k): str(v) for k,v in index.get('metadata',{}).items()}
+        self.shards = {shard: safe_open(shard,framework=framework,device=device) for shard in set(self.weight_map.values())}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        for shard in self.shards.values():
+            shard.__exit__(*args)
+
+    def keys(self) -> list:
+        return list(self.weight_map.keys())
+
+    def shard(self,key):
+        try:
+            return self.shards[self.weight_map[key]]
+        except KeyError:
+            raise SafetensorError(f'File does not contain tensor {key}')
+
+    def get_tensor(self,key):
+        return self.shard(key).get_tensor(key)
+
+    def get_slice(self,key):
+        return self.shard(key).get_slice(key)
+
+    def metadata(self) -> dict:
+        metadata = dict(self.index_metadata)
+        for shard in self.shards.values():
+            metadata.update(shard.metadata() or {})
+        return metadata
+
+
+def tensor_view(buffer,entry,offset=0):
+    #Tensor for a header entry as a view of a uint8 buffer holding the data section at offset
+    begin, end = entry['data_offsets']
+    data = buffer[offset+begin:offset+end]
+    dtype = getattr(torch,DTYPE_NAMES[entry['dtype']])
+    try:
+        return data.view(dtype).view(entry['shape'])
+    except RuntimeError: #Offset not aligned to the element size
+        return data.clone().view(dtype).view(entry['shape'])
+
+
+def map_files(header) -> dict:
+    #{filename: (mmap, uint8 tensor over it)} for every file holding tensors of the header, copy-on-write so views are writable
+    files = {}
+    for filename in set(entry['file'] for entry in header.values()):
+        with open(filename,'rb') as file:
+            mapped = mmap.mmap(file.fileno(),0,access=mmap.ACCESS_COPY)
+        files[filename] = (mapped,torch.frombuffer(mapped,dtype=torch.uint8))
+    return files
+
+
+def release_pages(mapped,entry):
+    #Drops the pages of a tensor from the mapping, they are read again from the file if touched later
+    if not hasattr(mmap,'MADV_DONTNEED'): return
+    begin, end = (entry['start'] + offset for offset in entry['data_offsets'])
+    begin, end = -(-begin // mmap.PAGESIZE) * mmap.PAGESIZE, end // mmap.PAGESIZE * mmap.PAGESIZE
+    if end > begin:
+        mapped.madvise(mmap.MADV_DONTNEED,begin,end-begin)
+
+
+def mmap_state_dict(filename) -> dict:
+    #Copy-on-write views of the mapped file, the data stays in the page cache instead of a second copy in memory
+    header = read_header(filename)
+    files = map_files(header)
+    return {key: tensor_view(files[entry['file']][1],entry,entry['start']) for key,entry in header.items()}
+
+
+def write_safetensors(filename,entries,metadata=None):
+    #entries: [(key, shape, torch dtype, produce)], produce() returns the tensor when its turn to be written comes,
+    #so only one tensor has to exist in its saved form at a time
+    names = {getattr(torch,name): tag for tag,name in DTYPE_NAMES.items()}
+    header = {'__metadata__': metadata} if metadata else {}
+    offset = 0
+    for key,shape,dtype,_ in entries:
+        size = math.prod(shape) * torch.empty((),dtype=dtype).element_size()
+        header[key] = {'dtype': names[dtype], 'shape': list(shape), 'data_offsets': [offset,offset+size]}
+        offset += size
+    encoded = json.dumps(header,separators=(',',':')).encode()
+    encoded += b' ' * (-len(encoded) % 8)
+
+    with open(filename,'wb') as file:
+        file.write(struct.pack('<Q',len(encoded)))
+        file.write(encoded)
+        for key,shape,dtype,produce in entries:
+            tensor = produce().detach().to('cpu',dtype).contiguous()
+            file.write(tensor.reshape(-1).view(torch.uint8).numpy())
+
+
+class BulkCheckpoint:
+    #Whole checkpoint in one contiguous buffer per file on the device, read with one large read per file.
+    #get_tensor returns views into the buffer, so tensors from it must not be modified in place.
+    def __init__(self,filename,device='cpu'):
+        self.filename = filename
+        probe_result = probe(filename)
+        self.header, self.meta = probe_result.header, probe_result.metadata
+        self.buffers = {}
+        for file in set(entry['file'] for entry in self.header.values()):
+            start = min(entry['start'] for entry in self.header.values() if entry['file'] == file)
+            host = torch.empty(os.path.getsize(file) - start,dtype=torch.uint8,pin_memory=device != 'cpu')
+            with open(file,'rb') as stream:
+                stream.seek(start)
+                stream.readinto(memoryview(host.numpy()))
+            self.buffers[file] = host.to(device,non_blocking=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.buffers.clear()
+
+    def keys(self) -> list:
+        return list(self.header)
+
+    def get_tensor(self,key):
+        try:
+            entry = self.header[key]
+        except KeyError:
+            raise SafetensorError(f'File does not contain tensor {key}')
+        return tensor_view(self.buffers[entry['file']],entry)
+
+    def metadata(self) -> dict:
+        return self.meta
+
+
+def checkpoint_nbytes(filename) -> int:
+    return sum(entry_nbytes(entry) for entry in probe(filename).header.values())
+
+
+def open_checkpoint(filename,device='cpu'):
+    if is_sharded(filename):
+        return ShardedSafeOpen(filename,framework='pt',device=device)
+    return safe_open(filename,framework='pt',device=device)
@@ -0,0 +1,131 @@
+import time,os,platform,concurrent.futures,torch
+import scripts.untitled.common as cmn
+import scripts.untitled.operators as opr
+import scripts.untitled.calcmodes as calcmodes
+
+#Short calibration on a sample of the keys about to be merged. Measures the throughput of the calcmode on every
+#usable device, how it scales with the thread count and with the chunk size, then picks threads, device and chunk size.
+#Profiles are stored per machine, calcmode and architecture in the options file and reused until cleared.
+
+PROFILES_KEY = 'autotune_profiles'
+SAMPLE_KEYS = 8
+THREAD_COUNTS = (1,2,4,8,12,16,20)
+CHUNK_SIZES = (2**20,2**22,2**24)
+
+def machine_id() -> str:
+    return platform.node() or 'default'
+
+
+def profiles() -> dict:
+    return cmn.opts.options.setdefault(PROFILES_KEY,{}).setdefault(machine_id(),{})
+
+
+def profile_name(calcmode) -> str:
+    #Tensor sizes and counts differ a lot between architectures, so the same calcmode is tuned per architecture
+    return calcmode.name+'/'+cmn.arch.name
+
+
+def clear_profiles() -> str:
+    cmn.opts.options.pop(PROFILES_KEY,None)
+    cmn.opts.save_key(PROFILES_KEY)
+    return 'Tuning profiles cleared'
+
+
+def apply(progress,calcmode,tasks,checkpoints,open_files):
+    #open_files: context manager taking (checkpoints,device) that sets up the files like the real merge does
+    cmn.tuned = {}
+    if not tasks: return
+    name = profile_name(calcmode)
+    profile = profiles().get(name)
+    if profile is None:
+        progress('Calibrating for this machine...')
+        profile = calibrate(calcmode,tasks,checkpoints,open_files)
+        profiles()[name] = profile
+        cmn.opts.save_key(PROFILES_KEY)
+    cmn.tuned = {name: profile[name] for name in ('device','threads','chunk_size')}
+    progress('Auto-tuned',v=f"{profile['device']}, {profile['threads']} threads")
+
+
+class NoCache:
+    #Stands in for the weights cache so repeated runs don't measure cache hits, the read cache is swapped for a disabled one
+    def __getitem__(self,key):
+        raise KeyError(key)
+
+    def __setitem__(self,key,value): pass
+
+
+def device_candidates() -> list:
+    dtype = cmn.opts['device'].split('/')[1]
+    candidates = ['cpu/bfloat16' if dtype == 'bfloat16' else 'cpu/float32']
+    if torch.cuda.is_available():
+        candidates.append('cuda/'+dtype)
+    return candidates
+
+
+def sample_tasks(tasks) -> list:
+    #Evenly spread over the merged keys sorted by cost, so both small and large tensors are represented
+    merged = sorted((task for task in tasks if task.template.calcmode is not None),key=lambda task: task.cost)
+    if not merged:
+        merged = sorted(tasks,key=lambda task: task.cost)
+    step = max(1,len(merged)//SAMPLE_KEYS)
+    return merged[step//2::step][:SAMPLE_KEYS]
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def run_sample(sample,threads):
+    #Enough copies of the sample that every thread has work, fresh LazyRecipes so nothing is reused
+    copies = max(1,-(-threads*2 // len(sample)))
+    work = [calcmodes.LazyRecipe(task.key,task.template) for _ in range(copies) for task in sample]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for _ in executor.map(lambda task: task.build().merge(),work):
+            cmn.check_stop()
+    return sum(task.cost for task in sample) * copies
+
+
+def calibrate(calcmode,tasks,checkpoints,open_files) -> dict:
+    sample = sample_tasks(tasks)
+    thread_counts = [threads for threads in THREAD_COUNTS if threads <= (os.cpu_count() or 4) * 2]
+    weights_cache, read_cache = opr.weights_cache, opr.read_cache
+    opr.weights_cache, opr.read_cache = NoCache(), opr.ReadCache(0)
+    rates = {}
+    try:
+        for device in device_candidates():
+            cmn.tuned = {'device': device}
+            rates[device] = {}
+            with open_files(checkpoints,cmn.device()) as cmn.loaded_checkpoints:
+                run_sample(sample[:1],1) #Warm up kernels and the page cache
+                for threads in thread_counts:
+                    work = []
+                    seconds = timed(lambda: work.append(run_sample(sample,threads)))
+                    rates[device][threads] = work[0] / max(seconds,1e-9)
+                    #Past the knee more threads only add contention
+                    if threads > 1 and rates[device][threads] < max(rates[device].values()) * 0.95: break
+
+        device, threads = max(((device,threads) for device in rates for threads in rates[device]),key=lambda pair: rates[pair[0]][pair[1]])
+        cmn.tuned = {'device': device}
+        chunk_times = {}
+        with open_files(checkpoints,cmn.device()) as cmn.loaded_checkpoints:
+            for chunk_size in CHUNK_SIZES:
+                cmn.tuned['chunk_size'] = chunk_size
+                chunk_times[chunk_size] = timed(lambda: run_sample(sample,threads))
+    finally:
+        opr.weights_cache, opr.read_cache = weights_cache, read_cache
+        cmn.tuned = {}
+        cmn.loaded_checkpoints = None
+
+    return {
+        'device': device,
+        'threads': threads,
+        'chunk_size': min(chunk_times,key=chunk_times.get),
+        'rates': {device: {str(threads): round(rate) for threads,rate in device_rates.items()} for device,device_rates in rates.items()},
+        'sample_keys': [task.key for task in sample],
+        'time': time.time()
+    }
+
@@ -1,12 +1,63 @@
 from typing import Any
+import torch
 import scripts.untitled.operators as opr
 
 CALCMODES_LIST = []
 
+class RecipeTemplate:
+    #Shared by every key with the same calcmode, models and weights. calcmode=None loads the key from the first model
+    __slots__ = ('calcmode','checkpoints','weights','signature','alignment')
+
+    def __init__(self,calcmode,checkpoints,weights,alignment=None):
+        self.calcmode = calcmode
+        self.checkpoints = tuple(checkpoints)
+        self.weights = weights
+        self.alignment = alignment
+        self.signature = (calcmode.name if calcmode else None, self.checkpoints, tuple(sorted(weights.items())))
+
+    def __eq__(self,other):
+        return self.signature == other.signature
+
+    def __hash__(self):
+        return hash(self.signature)
+
+    def instantiate(self,key) -> opr.Operation:
+        if self.calcmode is None:
+            return opr.LoadTensor(key,self.checkpoints[0])
+        operation = self.calcmode.create_recipe(key,*self.checkpoints,**self.weights)
+        if self.alignment:
+            operation = self.alignment.rewrite(operation)
+        return operation
+
+
+class LazyRecipe:
+    #A key bound to a template, the operation tree is only built when a worker picks it up
+    __slots__ = ('key','template','operation','cost')
+
+    def __init__(self,key,template,cost=0):
+        self.key = key
+        self.template = template
+        self.operation = None
+        self.cost = cost #Estimated peak bytes while merging
+
+    def __eq__(self,other):
+        return isinstance(other,LazyRecipe) and self.key == other.key and self.template == other.template
+
+    def __hash__(self):
+        return hash((self.key,self.template))
+
+    def build(self) -> opr.Operation:
+        if self.operation is None:
+            self.operation = self.template.instantiate(self.key)
+        return self.operation
+
+
 class CalcMode:
     name = 'calcmode'
     description = 'description'
     input_models = 4
+    multi_model = False #Takes model_a..model_d plus any additional models, input_models is then the minimum
+    memory_factor = 6 #Full-size temporaries alive at once, used to estimate in-flight memory
     input_sliders = 3
 
     slid_a_info = '-'
@@ -24,11 +75,15 @@ class CalcMode:
     def create_recipe(self, key, model_a, model_b, model_c, model_d, seed=False, alpha=0, beta=0, gamma=0, delta=0) -> opr.Operation:
         raise NotImplementedError
 
+    #Optional, used by bulk mode: merges a list of keys at once with foreach ops, returns None if the weights aren't supported
+    merge_group = None
+
 
 class WeightSum(CalcMode):
     name = 'Weight-Sum'
     description = 'model_a * (1 - alpha) + model_b * alpha'
     input_models = 2
+    memory_factor = 5
     input_sliders = 1
     slid_a_info = "model_a - model_b"
     slid_a_config = (0, 1, 0.01)
@@ -48,6 +103,15 @@ class WeightSum(CalcMode):
         
         res = opr.Add(key, c, d)
         return res
+
+    def merge_group(keys, model_a, model_b, model_c, model_d, alpha=0, **kwargs):
+        if alpha >= 1:
+            return [opr.load_tensor(model_b,key) for key in keys]
+        a = [opr.load_tensor(model_a,key) for key in keys]
+        if alpha <= 0:
+            return a
+        b = [opr.load_tensor(model_b,key).to(tensor.dtype) for key,tensor in zip(keys,a)]
+        return torch._foreach_lerp(a, b, alpha)
     
 CALCMODES_LIST.append(WeightSum)
 
@@ -56,6 +120,7 @@ class InterpDifference(CalcMode):
     name = 'Comparative Interp'
     description = 'Interpolates between each pair of values from A and B depending on their difference relative to other values'
     input_models = 2
+    memory_factor = 8
     input_sliders = 3
     slid_a_info = "concave - convex"
     slid_a_config = (0, 1, 0.01)
@@ -79,6 +144,7 @@ class ManEnhInterpDifference(CalcMode):
     name = 'Enhanced Man Interp'
     description = 'Enchanced interpolation between each pair of values from A and B depending on their difference relative to other values'
     input_models = 2
+    memory_factor = 10
     input_sliders = 4
     slid_a_info = "interpolation strength"
     slid_a_config = (0, 1, 0.001)
@@ -104,6 +170,7 @@ class AutoEnhInterpDifference(CalcMode):
     name = 'Enhanced Auto Interp'
     description = 'Interpolates between each pair of values from A and B depending on their difference relative to other values'
     input_models = 2
+    memory_factor = 10
     input_sliders = 3
     slid_a_info = "interpolation strength"
     slid_a_config = (0, 1, 0.001)
@@ -127,6 +194,7 @@ class AddDifference(CalcMode):
     name = 'Add Difference'
     description = 'model_a + (model_b - model_c) * alpha'
     input_models = 3
+    memory_factor = 6
     input_sliders = 1
     slid_a_info = "addition multiplier"
     slid_a_config = (-1, 2, 0.01)
@@ -147,6 +215,16 @@ class AddDifference(CalcMode):
 
         res = opr.Add(key, a, diffm)
         return res
+
+    def merge_group(keys, model_a, model_b, model_c, model_d, alpha=0, beta=0, **kwargs):
+        if beta == 1:
+            return None
+        a = [opr.load_tensor(model_a,key) for key in keys]
+        diff = torch._foreach_sub([opr.load_tensor(model_b,key).to(tensor.dtype) for key,tensor in zip(keys,a)],
+                                  [opr.load_tensor(model_c,key).to(tensor.dtype) for key,tensor in zip(keys,a)])
+        torch._foreach_mul_(diff, alpha)
+        torch._foreach_add_(diff, a)
+        return diff
     
 CALCMODES_LIST.append(AddDifference)
 
@@ -155,6 +233,7 @@ class TrainDifference(CalcMode):
     name = 'Train Difference'
     description = 'model_a + (model_b - model_c) * alpha'
     input_models = 3
+    memory_factor = 10
     input_sliders = 1
     slid_a_info = "addition multiplier"
     slid_a_config = (-1, 2, 0.01)
@@ -179,6 +258,7 @@ class Extract(CalcMode):
     name = 'Extract'
     description = 'Adds (dis)similar features between (model_b - model_a) and (model_c - model_a) to model_a'
     input_models = 3
+    memory_factor = 6
     input_sliders = 4
     
     slid_a_info = 'model_b - model_c'
@@ -213,6 +293,7 @@ class AddDisimilarity(CalcMode):
     name = 'Add Dissimilarites'
     description = 'Adds dissimalar features between model_b and model_c to model_a'
     input_models = 3
+    memory_factor = 6
     input_sliders = 3
     
     slid_a_info = 'model_b - model_c'
@@ -244,6 +325,7 @@ class PowerUp(CalcMode):
     name = 'Power-up (DARE)'
     description = 'Adds the capabilities of model B to model A.'
     input_models = 2
+    memory_factor = 6
     input_sliders = 2
     slid_a_info = "dropout rate"
     slid_a_config = (0, 1, 0.01)
@@ -264,29 +346,83 @@ class PowerUp(CalcMode):
 CALCMODES_LIST.append(PowerUp)
 
 
-# class NotWorkingSingularValue(CalcMode):
-#     name = 'Singular Value Decomposition (SVD)'
-#     description = 'Adds the capabilities of model B to model A through value singular value decomposition.'
-#     input_models = 2
-#     input_sliders = 2
-#     slid_a_info = "threshold for significant singular values"
-#     slid_a_config = (0, 1, 0.01)
-#     slid_b_info = "used to determine which singular values to keep"
-#     slid_b_config = (-1, 4, 0.01)
-#     slid_c_info = "multiply weight of the singular value"
-#     slid_c_config = (-1, 4, 0.01)
-# 
-#     def create_recipe(key, model_a, model_b, model_c, model_d, alpha=0, beta=0, gamma=0, seed=0, **kwargs):
-#         a = opr.LoadTensor(key,model_a)
-#         b = opr.LoadTensor(key,model_b)
-# 
-#         svd = opr.SingularValueDeOperator(key, alpha, beta, seed, a, b)
-#         svd.cache()
-#         b.pop()
-# 
-#         res = opr.Multiply(key, gamma, svd)
-# 
-#         return opr.Add(key, a, res)
-# 
-# CALCMODES_LIST.append(NotWorkingSingularValue)
+class LowRankDifference(CalcMode):
+    name = 'Add Difference (low-rank)'
+    description = 'model_a + lowrank(model_b - model_c) * alpha'
+    input_models = 3
+    memory_factor = 6
+    input_sliders = 2
+    slid_a_info = "addition multiplier"
+    slid_a_config = (-1, 2, 0.01)
+    slid_b_info = "rank"
+    slid_b_config = (1, 256, 1)
+
+    def create_recipe(key, model_a, model_b, model_c, model_d, alpha=0, beta=0, seed=0, **kwargs):
+        a = opr.LoadTensor(key,model_a)
+        b = opr.LoadTensor(key,model_b)
+        c = opr.LoadTensor(key,model_c)
+
+        diff = opr.LowRankDifference(key, max(1,int(beta)), seed, b, c)
+        diff.cache()
+
+        diffm = opr.Multiply(key, alpha, diff)
+
+        return opr.Add(key, a, diffm)
+
+CALCMODES_LIST.append(LowRankDifference)
+
+
+### N-WAY
+#These take every selected model in one pass, model_weights holds one weight per model in the order they are
+#passed (model_a excluded where model_a is the base).
+
+class MultiWeightSum(CalcMode):
+    name = 'N-way Weight-Sum'
+    description = 'Weighted mean of all selected models'
+    input_models = 2
+    multi_model = True
+    memory_factor = 6
+    input_sliders = 0
+
+    def create_recipe(key, *models, model_weights=(), **kwargs):
+        return opr.WeightedMean(key, model_weights, *[opr.LoadTensor(key,model) for model in models])
+
+CALCMODES_LIST.append(MultiWeightSum)
+
+
+class MultiTies(CalcMode):
+    name = 'N-way TIES'
+    description = 'model_a + TIES(model_b - model_a, model_c - model_a, ...) * beta'
+    input_models = 3
+    multi_model = True
+    memory_factor = 14
+    input_sliders = 2
+    slid_a_info = "density"
+    slid_a_config = (0, 1, 0.01)
+    slid_b_info = "addition multiplier"
+    slid_b_config = (-1, 2, 0.01)
+
+    def create_recipe(key, model_a, *models, alpha=0, beta=0, model_weights=(), **kwargs):
+        a = opr.LoadTensor(key,model_a)
+        return opr.TiesMerge(key, model_weights, alpha, beta, a, *[opr.LoadTensor(key,model) for model in models])
+
+CALCMODES_LIST.append(MultiTies)
+
+
+class MultiDare(CalcMode):
+    name = 'N-way DARE'
+    description = 'model_a + sum(DARE(model_n - model_a)) * beta'
+    input_models = 3
+    multi_model = True
+    memory_factor = 8
+    input_sliders = 2
+    slid_a_info = "dropout rate"
+    slid_a_config = (0, 0.99, 0.01)
+    slid_b_info = "addition multiplier"
+    slid_b_config = (-1, 4, 0.01)
+
+    def create_recipe(key, model_a, *models, alpha=0, beta=0, seed=0, model_weights=(), **kwargs):
+        a = opr.LoadTensor(key,model_a)
+        return opr.DareMerge(key, model_weights, alpha, beta, seed, a, *[opr.LoadTensor(key,model) for model in models])
 
+CALCMODES_LIST.append(MultiDare)
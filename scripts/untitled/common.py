@@ -1,4 +1,5 @@
-import torch
+import torch,os
+from modules import paths_internal
 
 blocks = None
 opts = None
@@ -9,18 +10,53 @@ interrupted = False
 
 loaded_checkpoints = None
 checkpoints_types = None
+checkpoints_scales = {}
 primary = ""
+arch = None
 
 last_merge_tasks = tuple()
+last_merge_hashes = {} #{key: reuse task hash} of the last merge, finetuned keys excluded
+last_merge_id = None
+last_merge_recipe = None
+last_merge_file = None #(temp safetensors of the loaded merge, its precision)
 last_merge_seed = -1
 
+#Values picked by the auto-tuner for the current merge, they take precedence over the options
+tuned = {}
+CHUNK_SIZE = 2**22
+
+def data_dir(*parts) -> str:
+    #Files written at runtime live in the webui data folder, outside the extension and the checkpoint search paths
+    directory = os.path.join(paths_internal.data_path,'untitled_merger',*parts)
+    os.makedirs(directory,exist_ok=True)
+    return directory
+
+
+class MergeInterruptedError(Exception):
+    def __init__(self,*args):
+        super().__init__(*args)
+
+def check_stop():
+    #Cooperative cancellation point for workers, called between operators and tiles
+    if stop: raise MergeInterruptedError('Stopped')
+
+def device_option() -> str:
+    return tuned.get('device') or opts['device']
+
 def device():
-    device,dtype = opts['device'].split('/')
+    device,dtype = device_option().split('/')
     return device 
 
 def dtype():
-    device,dtype = opts['device'].split('/')
+    device,dtype = device_option().split('/')
     if dtype == 'float16': return torch.float16
+    elif dtype == 'bfloat16': return torch.bfloat16
     elif dtype == 'float8': return torch.float8_e4m3fn
     else: return torch.float32
 
+def threads() -> int:
+    return int(tuned.get('threads') or opts['threads'])
+
+def chunk_size() -> int:
+    #Elements per tile for operators that work on large tensors in pieces
+    return tuned.get('chunk_size') or CHUNK_SIZE
@@ -0,0 +1,93 @@
+import json,time,threading,torch
+try:
+    import resource
+except ImportError: #Windows
+    resource = None
+
+#Structured merge events. Listeners are called synchronously, possibly from several worker threads at once, with a dict:
+#{'event': name, 'time': unix time, ...fields}
+#
+#merge_started      tasks, checkpoints
+#task_started       key
+#task_finished      key, bytes_read, read_cache_hits, compute_ms, cache_hits, cache_misses, memory
+#                   bulk merged keys also have group, the number of keys merged together, and the stats of the whole group
+#                   keys reused in bulk mode only have key and reused
+#merge_finished     tasks, seconds, memory, cache (weights cache hits, misses, evictions, skipped, entries, bytes)
+#merge_interrupted  reason
+
+listeners = []
+lock = threading.Lock()
+task_stats = threading.local()
+
+def subscribe(callback):
+    with lock:
+        listeners.append(callback)
+
+
+def unsubscribe(callback):
+    with lock:
+        try:
+            listeners.remove(callback)
+        except ValueError: pass
+
+
+def emit(event,**fields):
+    if not listeners: return
+    fields = {'event': event, 'time': time.time(), **fields}
+    with lock:
+        callbacks = tuple(listeners)
+    for callback in callbacks: #Outside the lock so slow listeners don't serialize the merge threads
+        callback(fields)
+
+
+### PER TASK COUNTERS
+def begin_task():
+    task_stats.bytes_read = 0
+    task_stats.read_cache_hits = 0
+    task_stats.cache_hits = 0
+    task_stats.cache_misses = 0
+    task_stats.start = time.perf_counter()
+
+
+def discard_task():
+    #Leaves the task without reporting it, counts on this thread are ignored again until the next begin_task
+    task_stats.__dict__.clear()
+
+
+def count(name,n=1):
+    try:
+        setattr(task_stats,name,getattr(task_stats,name) + n)
+    except AttributeError: pass #Not inside a task
+
+
+def end_task() -> dict:
+    return {
+        'bytes_read': task_stats.bytes_read,
+        'read_cache_hits': task_stats.read_cache_hits,
+        'compute_ms': round((time.perf_counter() - task_stats.start) * 1000, 3),
+        'cache_hits': task_stats.cache_hits,
+        'cache_misses': task_stats.cache_misses,
+        'memory': memory_high_water()
+    }
+
+
+def memory_high_water() -> dict:
+    ram = None
+    if resource:
+        ram = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #KiB on linux
+    cuda = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None
+    return {'ram': ram, 'cuda': cuda}
+
+
+class JsonlLog:
+    def __init__(self,filename):
+        self.file = open(filename,'a',encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def __call__(self,event):
+        line = json.dumps(event,default=str) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,30 @@
+import threading,concurrent.futures
+from modules import hashes,sd_models
+
+#sha256 of input checkpoints, stored in merge recipes as their identity. Hashing goes through the webui hash cache
+#under the same title the webui uses, so a checkpoint is only read once whichever side hashes it first.
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=4,thread_name_prefix='untitled_hash')
+
+def file_sha256(filename) -> str|None:
+    #None if hashing is disabled in the webui. Sharded checkpoints are identified by the hash of their index file
+    return hashes.sha256(filename,'checkpoint/'+sd_models.CheckpointInfo(filename).name)
+
+
+def hash_files_async(filenames) -> dict:
+    return {filename: executor.submit(file_sha256,filename) for filename in dict.fromkeys(filter(None,filenames))}
+
+
+def on_hashed(futures,callback):
+    #Calls callback({filename: sha256}) once every future from hash_files_async is done, failed files are left out
+    remaining = [len(futures)]
+    counter_lock = threading.Lock()
+
+    def done(_):
+        with counter_lock:
+            remaining[0] -= 1
+            if remaining[0]: return
+        callback({filename: future.result() for filename,future in futures.items() if future.exception() is None})
+
+    for future in futures.values():
+        future.add_done_callback(done)
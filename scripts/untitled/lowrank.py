@@ -0,0 +1,64 @@
+import torch,re
+import scripts.untitled.rng as rng
+import scripts.untitled.common as cmn
+
+OVERSAMPLE = 8
+POWER_ITERATIONS = 2
+
+def randomized_svd(m,rank,generator,niter=POWER_ITERATIONS) -> tuple[torch.Tensor,torch.Tensor,torch.Tensor]:
+    #Halko et al. range finder, the test matrix comes from a KeyRNG so factors are reproducible across devices
+    q = min(rank + OVERSAMPLE, *m.shape)
+    omega = generator.uniform((m.shape[1],q),m.device) * 2 - 1
+    y = m @ omega
+    for _ in range(niter):
+        cmn.check_stop()
+        y, _ = torch.linalg.qr(y)
+        y = m @ (m.T @ y)
+    basis, _ = torch.linalg.qr(y)
+    u, s, vh = torch.linalg.svd(basis.T @ m, full_matrices=False)
+    return (basis @ u)[:,:rank], s[:rank], vh[:rank]
+
+
+def factorize(diff,rank,seed,key) -> tuple[torch.Tensor,torch.Tensor]:
+    #Returns up (out,rank) and down (rank,in*kh*kw) with up @ down ~= diff reshaped to 2D
+    m = diff.reshape(diff.shape[0],-1).float()
+    rank = max(1,min(int(rank),*m.shape))
+    u, s, vh = randomized_svd(m,rank,rng.KeyRNG(seed,key,'LowRank'))
+    return u * s, vh
+
+
+def is_factorizable(key,shape) -> bool:
+    return len(shape) in (2,4) and key.endswith('.weight') and 'embed' not in key
+
+
+### LoRA export
+LORA_PREFIXES = (
+    ('model.diffusion_model.','lora_unet_'),
+    ('cond_stage_model.transformer.','lora_te_'),
+    ('conditioner.embedders.0.transformer.','lora_te1_'),
+)
+
+#OpenCLIP encoders (SD2, SDXL te2) are exported under the kohya text_model names the webui maps back
+OPENCLIP_PREFIXES = (
+    ('cond_stage_model.model.transformer.resblocks.','lora_te_'),
+    ('conditioner.embedders.1.model.transformer.resblocks.','lora_te2_'),
+)
+OPENCLIP_LAYERS = {'mlp.c_fc':'mlp_fc1','mlp.c_proj':'mlp_fc2','attn.out_proj':'self_attn_out_proj'}
+
+def lora_key_name(key) -> str|None:
+    for prefix,lora_prefix in LORA_PREFIXES:
+        if key.startswith(prefix):
+            return lora_prefix + re.sub(r'\.weight$','',key[len(prefix):]).replace('.','_')
+    for prefix,lora_prefix in OPENCLIP_PREFIXES:
+        if key.startswith(prefix) and key.endswith('.weight'):
+            block, _, layer = key[len(prefix):-len('.weight')].partition('.')
+            if layer in OPENCLIP_LAYERS:
+                return f'{lora_prefix}text_model_encoder_layers_{block}_{OPENCLIP_LAYERS[layer]}'
+    return None
+
+
+def lora_factors(up,down,shape) -> tuple[torch.Tensor,torch.Tensor]:
+    #Conv weights: down keeps the kernel, up is a 1x1 conv
+    if len(shape) == 4:
+        return up.reshape(shape[0],-1,1,1), down.reshape(-1,*shape[1:])
+    return up, down
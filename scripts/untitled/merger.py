@@ -1,5 +1,4 @@
 import gradio as gr
-from safetensors.torch import safe_open
 from safetensors import SafetensorError
 import concurrent.futures
 from collections import defaultdict
@@ -7,41 +6,34 @@ import scripts.untitled.operators as oper
 import scripts.untitled.misc_util as mutil
 import scripts.untitled.common as cmn
 import scripts.untitled.calcmodes as calcmodes
+import scripts.untitled.lowrank as lowrank
+import scripts.untitled.recipe as recipe
+import scripts.untitled.architectures as arch
+import scripts.untitled.alignment as alignment
+import scripts.untitled.events as events
+import scripts.untitled.autotune as autotune
+import scripts.untitled.hashing as hashing
+import scripts.untitled.reuse as reuse
 from modules.timer import Timer
-import torch,os,re,gc,random
+import torch,os,re,gc,random,math,functools
 from tqdm import tqdm
 from copy import copy,deepcopy
 from modules import devices,shared,script_loading,paths,paths_internal,sd_models,sd_unet,sd_hijack
 
 networks = script_loading.load_module(os.path.join(paths.extensions_builtin_dir,'Lora','networks.py'))
 
-class MergeInterruptedError(Exception):
-    def __init__(self,*args):
-        super().__init__(*args)
-
-SKIP_KEYS = [
-    "alphas_cumprod",
-    "alphas_cumprod_prev",
-    "betas",
-    "log_one_minus_alphas_cumprod",
-    "posterior_log_variance_clipped",
-    "posterior_mean_coef1",
-    "posterior_mean_coef2",
-    "posterior_variance",
-    "sqrt_alphas_cumprod",
-    "sqrt_one_minus_alphas_cumprod",
-    "sqrt_recip_alphas_cumprod",
-    "sqrt_recipm1_alphas_cumprod"
-]
+MergeInterruptedError = cmn.MergeInterruptedError
 
 VALUE_NAMES = ('alpha','beta','gamma','delta')
 
+EVENT_LOG = os.path.join(cmn.data_dir(),'merge_events.jsonl')
+
 calcmode_selection = {}
 for calcmode_obj in calcmodes.CALCMODES_LIST:
     calcmode_selection.update({calcmode_obj.name: calcmode_obj})
 
 
-def parse_arguments(progress,calcmode_name,model_a,model_b,model_c,model_d,slider_a,slider_b,slider_c,slider_d,editor,discard,clude,clude_mode,seed,enable_sliders,active_sliders,*custom_sliders):
+def parse_arguments(progress,calcmode_name,model_a,model_b,model_c,model_d,extra_models,model_weights,slider_a,slider_b,slider_c,slider_d,editor,discard,clude,clude_mode,seed,enable_sliders,active_sliders,*custom_sliders):
     calcmode = calcmode_selection[calcmode_name]
     parsed_targets = {}
 
@@ -78,52 +70,63 @@ def parse_arguments(progress,calcmode_name,model_a,model_b,model_c,model_d,slide
                     parsed_targets[selector][VALUE_NAMES[n]] = float(weight)
                 except ValueError:pass
 
+    models = (model_a,model_b,model_c,model_d)
+    if calcmode.multi_model:
+        models = [model for model in models if model] + list(extra_models or [])
+        models += [''] * (calcmode.input_models - len(models)) #Reported as missing below
+        model_weights = tuple(float(weight) for weight in re.findall(r'[-+]?\d*\.?\d+',model_weights or ''))
+        for target in parsed_targets.values():
+            target['model_weights'] = model_weights
+
     checkpoints = []
     progress('Using Checkpoints:')
-    for n, model in enumerate((model_a,model_b,model_c,model_d)):
-        if n+1 > calcmode.input_models:
+    for n, model in enumerate(models):
+        if n+1 > calcmode.input_models and not calcmode.multi_model:
             checkpoints.append('')
             continue
         name = model.split(' ')[0]
-        checkpoint_info = sd_models.get_closet_checkpoint_match(name)
-        if checkpoint_info == None: 
+        filename = mutil.resolve_checkpoint(model) if model else None
+        if filename == None: 
             if model:
                 progress.interrupt('Couldn\'t find checkpoint: '+name)
             else:
                 progress.interrupt('Missing input model')
-        if not checkpoint_info.filename.endswith('.safetensors'): 
+        if not filename.endswith('.safetensors') and not arch.is_sharded(filename): 
             progress.interrupt('This extension only supports safetensors checkpoints: '+name)
         progress(' - '+name)
-        checkpoints.append(checkpoint_info.filename)
+        checkpoints.append(filename)
     cmn.primary = checkpoints[0]
 
     discards = re.findall(r'[^\s]+', discard, flags=re.I|re.M)
     cludes = re.findall(r'[^\s]+', clude, flags=re.I|re.M)
 
-    with safe_open(cmn.primary,framework='pt',device='cpu') as file:
-        keys = file.keys()
+    probes = arch.probe_all(checkpoints)
+    cmn.checkpoints_types = {checkpoint: probe.name for checkpoint,probe in probes.items()}
+    keys = probes[cmn.primary].keys()
+    cmn.arch = probes[cmn.primary].arch
+    progress('Architecture',v=cmn.arch.name)
 
-    discard_regex = re.compile(mutil.target_to_regex(discards))
-    discard_keys = list(filter(lambda x: re.search(discard_regex,x),keys))
+    discard_regex = re.compile(mutil.target_to_regex(discards,cmn.arch.selectors))
+    discard_keys = set(filter(lambda x: re.search(discard_regex,x),keys))
 
     desired_keys = keys
     if cludes:
-        clude_regex = re.compile(mutil.target_to_regex(cludes))
+        clude_regex = re.compile(mutil.target_to_regex(cludes,cmn.arch.selectors))
         if clude_mode.lower() == 'exclude':
             desired_keys = list(filter(lambda x: not re.search(clude_regex,x),keys))
         else:
             desired_keys = list(filter(lambda x: re.search(clude_regex,x),keys))
 
-    assigned_keys = assign_weights_to_keys(parsed_targets,desired_keys)
+    assigned_keys = assign_weights_to_keys(parsed_targets,desired_keys,selectors=cmn.arch.selectors)
     return calcmode, keys, assigned_keys, discard_keys, checkpoints
 
 
-def assign_weights_to_keys(targets,keys,already_assigned=None) -> dict:
+def assign_weights_to_keys(targets,keys,already_assigned=None,selectors=None) -> dict:
     weight_assigners = []
     keystext = "\n".join(keys)
 
     for target_name,weights in targets.items():
-        regex = mutil.target_to_regex(target_name)
+        regex = mutil.target_to_regex(target_name,selectors)
 
         weight_assigners.append((weights, regex))
     
@@ -147,17 +150,40 @@ def assign_weights_to_keys(targets,keys,already_assigned=None) -> dict:
 
 
 def create_tasks(progress, calcmode, keys, assigned_keys, discard_keys,checkpoints):
+    #Keys with identical weights share one template, recipes are built lazily by the workers
+    headers = {checkpoint: probe.header for checkpoint,probe in arch.probe_all(checkpoints).items()}
+    alignment_plan = alignment.Alignment(cmn.primary,headers)
+
+    load_primary = calcmodes.RecipeTemplate(None,(cmn.primary,),{})
+    templates = {}
     tasks = []
+    merge_keys = set()
     n = 0
+    primary_header = headers[cmn.primary]
+    compute_size = torch.finfo(cmn.dtype()).bits // 8
     for key in keys:
+        entry = primary_header[key]
+        size = math.prod(entry['shape']) * max(arch.DTYPE_SIZES.get(entry['dtype'],4),compute_size)
         if key in discard_keys:continue
-        elif key in SKIP_KEYS or 'model_ema' in key or 'first_stage_model' in key:
-            tasks.append(oper.LoadTensor(key,cmn.primary))
-        elif key in assigned_keys.keys():
+        elif cmn.arch.is_skipped(key):
+            tasks.append(calcmodes.LazyRecipe(key,load_primary,size))
+        elif key in alignment_plan.fallback:
+            if key in assigned_keys:
+                merge_keys.add(key)
+            tasks.append(calcmodes.LazyRecipe(key,load_primary,size))
+        elif key in assigned_keys:
+            merge_keys.add(key)
             n += 1
-            tasks.append(calcmode.create_recipe(key,*checkpoints,**assigned_keys[key]))
+            weights = assigned_keys[key]
+            signature = tuple(sorted(weights.items()))
+            template = templates.get(signature)
+            if template is None:
+                template = templates[signature] = calcmodes.RecipeTemplate(calcmode,checkpoints,weights,alignment_plan)
+            tasks.append(calcmodes.LazyRecipe(key,template,size*calcmode.memory_factor))
         else:
-            tasks.append(oper.LoadTensor(key,cmn.primary))
+            tasks.append(calcmodes.LazyRecipe(key,load_primary,size))
+
+    alignment_plan.report(progress,merge_keys)
 
     progress('Assigned tasks: ')
     progress('Merges', v=n)
@@ -172,24 +198,67 @@ def prepare_merge(progress,save_name,save_settings,finetune,*merge_args):
     cmn.stop = False
 
     calcmode, keys, assigned_keys, discard_keys, checkpoints = parse_arguments(progress,*merge_args)
+    #Input hashes are computed alongside the merge, cached files return immediately
+    hash_futures = hashing.hash_files_async(checkpoints) if cmn.opts['hash_models'] else {}
     
     tasks = create_tasks(progress, calcmode, keys, assigned_keys, discard_keys, checkpoints)
 
+    cmn.tuned = {}
+
     sd_unet.apply_unet("None")
     sd_hijack.model_hijack.undo_hijack(shared.sd_model)
 
     #Merge process begins here:
-    state_dict = merge(progress,tasks,checkpoints,finetune,timer)
+    event_log = events.JsonlLog(EVENT_LOG) if cmn.opts['event_log'] else None
+    if event_log: events.subscribe(event_log)
+    try:
+        state_dict = merge(progress,calcmode,tasks,checkpoints,finetune,timer)
+        events.emit('merge_finished',tasks=len(tasks),seconds=timer.total,memory=events.memory_high_water(),cache=oper.weights_cache.stats())
+    except MergeInterruptedError:
+        events.emit('merge_interrupted',reason=progress.get_report())
+        raise
+    finally:
+        cmn.tuned = {} #Tuned settings only apply to the merge itself
+        if event_log:
+            events.unsubscribe(event_log)
+            event_log.close()
+    #Hashes still being computed are attached once they finish, the model load doesn't wait for them
+    hashes = {checkpoint: future.result() for checkpoint,future in hash_futures.items() if future.done() and future.exception() is None}
+    build_recipe = functools.partial(recipe.build,cmn.last_merge_tasks,checkpoints,calcmode.name,cmn.last_merge_seed,finetune)
+    cmn.last_merge_recipe = build_recipe(hashes)
 
     merge_name = mutil.create_name(checkpoints,calcmode.name,0)
 
-    checkpoint_info = deepcopy(sd_models.get_closet_checkpoint_match(os.path.basename(cmn.primary)))
-    checkpoint_info.short_title = hash(cmn.last_merge_tasks)
+    checkpoint_info = deepcopy(sd_models.get_closet_checkpoint_match(os.path.basename(cmn.primary))) or sd_models.CheckpointInfo(cmn.primary)
+    checkpoint_info.short_title = cmn.last_merge_id
     checkpoint_info.name_for_extra = '_TEMP_MERGE_'+merge_name
 
+    #Stored for reuse before saving casts the state dict to the save precision. Merges that don't fit in RAM
+    #are mapped from the saved file instead, those are only reused by merges in the same dtype
+    output_file = ('fp8' not in save_settings) if 'Autosave' in save_settings else cmn.opts['mmap_output']
+    stored = reuse.store.add(cmn.last_merge_id,state_dict,cmn.last_merge_hashes,spill=not output_file)
+
+    #With mmap output the model is loaded from the written file so the merged tensors aren't held in memory twice
+    mmap_source = None
+    mutil.discard_temp_checkpoint()
     if 'Autosave' in save_settings:
-        checkpoint_info = mutil.save_state_dict(state_dict,save_name or merge_name,save_settings,timer)
-    
+        checkpoint_info = mutil.save_state_dict(state_dict,save_name or merge_name,save_settings,timer,cmn.last_merge_recipe)
+        if 'fp8' not in save_settings:
+            mmap_source = checkpoint_info.filename
+    elif cmn.opts['mmap_output']:
+        mmap_source = mutil.save_temp_state_dict(state_dict,merge_name,save_settings,cmn.last_merge_recipe)
+        timer.record('Write temp checkpoint')
+
+    if len(hashes) < len(hash_futures):
+        hashing.on_hashed(hash_futures,functools.partial(attach_hashes,cmn.last_merge_id,build_recipe,checkpoint_info.filename if 'Autosave' in save_settings else None))
+
+    if not stored and mmap_source:
+        reuse.store.add(cmn.last_merge_id,state_dict,cmn.last_merge_hashes,mmap_source)
+
+    if cmn.opts['mmap_output'] and mmap_source:
+        state_dict.clear()
+        state_dict = arch.mmap_state_dict(mmap_source)
+
     with mutil.NoCaching():
         mutil.load_merged_state_dict(state_dict,checkpoint_info)
     
@@ -200,21 +269,22 @@ def prepare_merge(progress,save_name,save_settings,finetune,*merge_args):
     progress('Merge completed in ' + timer.summary(), report=True)
 
 
-def merge(progress,tasks,checkpoints,finetune,timer) -> dict:
+def attach_hashes(merge_id,build_recipe,saved_file,hashes):
+    #Runs on a hashing thread, skipped if another merge has replaced this one
+    if cmn.last_merge_id != merge_id: return
+    cmn.last_merge_recipe = build_recipe(hashes)
+    if saved_file:
+        recipe.save_sidecar(cmn.last_merge_recipe,saved_file)
+
+
+def merge(progress,calcmode,tasks,checkpoints,finetune,timer) -> dict:
     progress('### Starting merge ###')
-    cmn.checkpoints_types = {checkpoint:mutil.id_checkpoint(checkpoint)[0] for checkpoint in checkpoints}
     tasks_copy = copy(tasks)
     if shared.sd_model and shared.sd_model.device != 'cpu':
         sd_models.unload_model_weights(shared.sd_model)
 
     state_dict = {}
 
-    #Reuse merged tensors from the last merge's loaded model, if availible
-    if shared.sd_model and shared.sd_model.sd_checkpoint_info.short_title == hash(cmn.last_merge_tasks):
-        state_dict,tasks = get_tensors_from_loaded_model(state_dict,tasks)
-        if len(state_dict) > 0:
-            progress('Reusing from loaded model',v=len(state_dict))
-    
     is_sdxl = any([type in cmn.checkpoints_types.values() for type in ['SDXL','SDXL-refiner']])
     if ('SDXL' in cmn.opts['trash_model'] and is_sdxl) or cmn.opts['trash_model'] == 'Enable':
         progress('Unloading webui models...')
@@ -225,22 +295,34 @@ def merge(progress,tasks,checkpoints,finetune,timer) -> dict:
         shared.sd_model = None
     devices.torch_gc()
 
+    #Calibrated only now so the webui model isn't holding VRAM during the measurements
+    if cmn.opts['autotune']:
+        autotune.apply(progress,calcmode,tasks,checkpoints,safe_open_multiple)
+
+    #Merged tensors of recent merges are reused, matched by the hash of each key's task. Created after
+    #autotune so the lookup uses the dtype the merge actually runs in
+    lookup = reuse.MergeLookup(checkpoints) if reuse.enabled() else None
+
     timer.record('Prepare merge')
+    events.emit('merge_started',tasks=len(tasks),checkpoints=[c for c in checkpoints if c])
     progressbar = tqdm(None,total=len(tasks),desc='Merging..')
-    with safe_open_multiple(checkpoints,device=cmn.device()) as cmn.loaded_checkpoints:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=cmn.opts['threads']) as executor:
-            futures = [executor.submit(initialize_task, task) for task in tasks]
-            while True:
-                done, not_done = concurrent.futures.wait(futures,timeout=0.1)
-                progressbar.update(len(done)-progressbar.n)
-                if cmn.stop:
-                    progress.interrupt('Stopped',popup=False)
-                    
-                if len(not_done) == 0:
-                    results = [future.result() for future in done]
-                    break
-    
-    state_dict.update(dict(results))
+    bulk = use_bulk(checkpoints)
+    if bulk:
+        progress('Bulk mode: loading whole models to '+cmn.device())
+    oper.read_cache.prepare(() if bulk else checkpoints) #Bulk mode already reads whole models
+    with safe_open_multiple(checkpoints,device=cmn.device(),bulk=bulk) as cmn.loaded_checkpoints:
+        if bulk:
+            tasks = run_bulk(tasks,progressbar,state_dict,lookup)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=cmn.threads()) as executor:
+            run_tasks(progress,executor,tasks,progressbar,state_dict,lookup)
+    reused = lookup.reused if lookup else set()
+    if reused:
+        progress('Reused from recent merges',v=len(reused))
+    if bulk:
+        #Outputs that still view a model buffer are copied out so the buffers can be freed
+        for key,tensor in state_dict.items():
+            if key not in reused and tensor._base is not None:
+                state_dict[key] = tensor.clone()
 
     fine = fineman(finetune, 'SDXL' in cmn.checkpoints_types[cmn.primary])
     if finetune:
@@ -257,16 +339,137 @@ def merge(progress,tasks,checkpoints,finetune,timer) -> dict:
 
 
     cmn.last_merge_tasks = tuple(tasks_copy)
+    hashes = lookup.hashes if lookup else {}
+    cmn.last_merge_hashes = {task.key: hashes[task.key] for task in tasks_copy if task.key in hashes}
+    cmn.last_merge_id = (reuse.merge_id(hashes) if hashes else str(hash(cmn.last_merge_tasks))) + ('-'+finetune if finetune else '')
             
     timer.record('Merge')
     return state_dict
 
 
-def initialize_task(task) -> tuple:
+def run_tasks(progress,executor,tasks,progressbar,state_dict,lookup=None):
+    #Only a small window of tasks is submitted at a time so a stop only has to wait for the running ones.
+    #Tasks are also admitted by their estimated peak bytes, results are moved into state_dict as soon as they finish.
+    window = cmn.threads() * 2
+    budget = memory_budget()
+    task_iter = iter(tasks)
+    pending = {}
+    in_flight = 0
+    waiting = None
+
+    def fill():
+        nonlocal in_flight, waiting
+        while len(pending) < window:
+            task = waiting or next(task_iter,None)
+            if task is None: break
+            cost = getattr(task,'cost',0)
+            if pending and in_flight + cost > budget:
+                waiting = task
+                break
+            waiting = None
+            in_flight += cost
+            pending[executor.submit(initialize_task,task,lookup)] = cost
+
+    fill()
+    while pending:
+        done, _ = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            in_flight -= pending.pop(future)
+            try:
+                key, tensor = future.result()
+                state_dict[key] = tensor
+            except MergeInterruptedError: pass
+            progressbar.update(1)
+
+        if cmn.stop:
+            for future in pending:
+                future.cancel()
+            progress.interrupt('Stopped',popup=False)
+        fill()
+
+
+BULK_GROUP = 256
+
+def use_bulk(checkpoints) -> bool:
+    #Bulk mode needs every input model plus the output and some headroom to fit in free VRAM
+    if not cmn.opts['bulk_mode'] or cmn.device() != 'cuda' or not torch.cuda.is_available():
+        return False
+    needed = sum(arch.checkpoint_nbytes(checkpoint) for checkpoint in set(checkpoints) if checkpoint)
+    needed += arch.checkpoint_nbytes(cmn.primary) * 2
+    return needed < torch.cuda.mem_get_info()[0] * 0.9
+
+
+def run_bulk(tasks,progressbar,state_dict,lookup=None) -> list:
+    #Keys sharing a template whose calcmode has merge_group are merged in groups with foreach ops,
+    #unsupported tasks are returned for the thread pool. Reused keys are left out of their group
+    groups = defaultdict(list)
+    remaining = []
+    for task in tasks:
+        template = task.template
+        aligned = template.alignment and template.alignment.affects(task.key)
+        if template.calcmode is None or (template.calcmode.merge_group and not aligned):
+            groups[template].append(task)
+        else:
+            remaining.append(task)
+
+    for template,group in groups.items():
+        for start in range(0,len(group),BULK_GROUP):
+            cmn.check_stop()
+            batch = group[start:start+BULK_GROUP]
+            if lookup:
+                missing = []
+                for task in batch:
+                    tensor = lookup(task.key,task.build())
+                    if tensor is None:
+                        missing.append(task)
+                    else:
+                        state_dict[task.key] = tensor
+                        events.emit('task_finished',key=task.key,reused=True)
+                progressbar.update(len(batch) - len(missing))
+                batch = missing
+                if not batch: continue
+            keys = [task.key for task in batch]
+            events.begin_task()
+            if template.calcmode is None:
+                tensors = [oper.load_tensor(template.checkpoints[0],key) for key in keys]
+            else:
+                tensors = template.calcmode.merge_group(keys,*template.checkpoints,**template.weights)
+                if tensors is None:
+                    #Not groupable with these weights, the rest of the template goes to the thread pool
+                    events.discard_task()
+                    remaining.extend(batch)
+                    remaining.extend(group[start+BULK_GROUP:])
+                    break
+            state_dict.update(zip(keys,tensors))
+            stats = events.end_task()
+            for key in keys:
+                events.emit('task_finished',key=key,group=len(keys),**stats)
+            progressbar.update(len(batch))
+    return remaining
+
+
+def memory_budget() -> int:
+    #Bytes of merge temporaries allowed in flight, 0 in the options means half of the free memory on the merge device
+    budget = cmn.opts['memory_budget'] or 0
+    if budget > 0:
+        return budget*1024*1024
+    if cmn.device() == 'cuda' and torch.cuda.is_available():
+        return torch.cuda.mem_get_info()[0] // 2
     try:
-        tensor = task.merge()
-    except SafetensorError: #Fallback in case one of the secondary models lack a key present in the primary model
-        tensor = cmn.loaded_checkpoints[cmn.primary].get_tensor(task.key)
+        import psutil
+        return psutil.virtual_memory().available // 2
+    except ImportError:
+        return 4096*1024*1024
+
+
+def initialize_task(task,lookup=None) -> tuple:
+    events.begin_task()
+    events.emit('task_started',key=task.key)
+    operation = task.build()
+    tensor = lookup(task.key,operation) if lookup else None
+    if tensor is None:
+        tensor = operation.merge()
+    events.emit('task_finished',key=task.key,**events.end_task())
 
     #tensor = tensor.detach().cpu()
     devices.torch_gc()
@@ -274,51 +477,104 @@ def initialize_task(task) -> tuple:
     return (task.key, tensor)
 
 
-def get_tensors_from_loaded_model(state_dict,tasks) -> dict:
-    intersected = set(cmn.last_merge_tasks).intersection(set(tasks))
-    if intersected:
-        with torch.no_grad():
-            for module in shared.sd_model.modules():
-                networks.network_restore_weights_from_backup(module)
-
-        old_state_dict = shared.sd_model.state_dict()
-
-        for task in intersected:
-            try:
-                state_dict[task.key] = old_state_dict[task.key]
-            except:pass
-            tasks.remove(task)
-        
-    return state_dict,tasks
-
-
 class safe_open_multiple(object):
-    def __init__(self,checkpoints,device):
+    def __init__(self,checkpoints,device,bulk=False):
         self.checkpoints = checkpoints
         self.device = device
+        self.bulk = bulk
         self.open_files = {}
      
     def __enter__(self):
         for name in self.checkpoints:
-            if name:
+            if name and name not in self.open_files:
                 filename = os.path.join(paths_internal.models_path,'Stable-diffusion',name)
-                self.open_files[name] = safe_open(filename,framework='pt',device=self.device)
+                if self.bulk:
+                    self.open_files[name] = arch.BulkCheckpoint(filename,device=self.device)
+                else:
+                    self.open_files[name] = arch.open_checkpoint(filename,device=self.device)
+                cmn.checkpoints_scales[name] = mutil.read_fp8_scales(self.open_files[name])
         return self.open_files
 
     def __exit__(self,*args):
         for file in self.open_files.values():
             file.__exit__(*args)
+        cmn.checkpoints_scales.clear()
+
+
+def extract_lora(progress,model_b,model_c,rank,conv_rank,save_name,precision):
+    progress('\n### Extracting LoRA ###')
+    timer = Timer()
+    cmn.stop = False
+    checkpoints = []
+    for model in (model_b,model_c):
+        filename = mutil.resolve_checkpoint(model) if model else None
+        if filename == None:
+            progress.interrupt('Missing input model')
+        checkpoints.append(filename)
+    seed = cmn.last_merge_seed if cmn.last_merge_seed >= 0 else 0
+
+    def extract(key):
+        cmn.check_stop()
+        shape = tuned.get_slice(key).get_shape()
+        if lowrank.lora_key_name(key) is None or not lowrank.is_factorizable(key,shape): return None
+        key_rank = conv_rank if len(shape) == 4 and shape[-1] > 1 else rank
+        if key_rank < 1: return None
+        try:
+            if base.get_slice(key).get_shape() != shape:
+                mismatched.append(key)
+                return None
+            diff = tuned.get_tensor(key).float() - base.get_tensor(key).float()
+        except SafetensorError: return None
+        up, down = lowrank.factorize(diff,key_rank,seed,key)
+        return key, *lowrank.lora_factors(up,down,shape)
+
+    lora = {}
+    mismatched = []
+    with arch.open_checkpoint(checkpoints[0],cmn.device()) as tuned, arch.open_checkpoint(checkpoints[1],cmn.device()) as base:
+        keys = tuned.keys()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=cmn.threads()) as executor:
+            for result in tqdm(executor.map(extract,keys),total=len(keys),desc='Extracting..'):
+                if cmn.stop:
+                    progress.interrupt('Stopped',popup=False)
+                if result is None: continue
+                key, up, down = result
+                name = lowrank.lora_key_name(key)
+                lora[name+'.lora_up.weight'] = up.to('cpu',precision).contiguous()
+                lora[name+'.lora_down.weight'] = down.to('cpu',precision).contiguous()
+                lora[name+'.alpha'] = torch.tensor(float(up.shape[1]))
+    timer.record('Extract')
+
+    progress('Extracted modules',v=len(lora)//3)
+    if mismatched:
+        progress('Skipped (shape mismatch)',v=len(mismatched))
+        for key in sorted(mismatched):
+            progress('Mismatched '+key)
+    name = save_name or mutil.create_name(checkpoints,'lora',rank)
+    filename = mutil.save_lora(lora,name,{'ss_network_dim':str(rank),'ss_network_alpha':str(rank),'ss_network_module':'networks.lora'})
+    timer.record('Save LoRA')
+    progress('LoRA saved as '+filename+' in '+timer.summary(),report=True)
 
 
 def clear_cache():
     oper.weights_cache.__init__(cmn.opts['cache_size'])
+    oper.read_cache.__init__(cmn.opts['read_cache'])
     gc.collect()
     devices.torch_gc()
     torch.cuda.empty_cache()
     cmn.last_merge_tasks = tuple() #Not a cache but is included here to give the user a way to get around it
+    reuse.store.clear()
+    cmn.last_merge_recipe = None
     return "All caches cleared"
 
 
+def release_merge():
+    #After a failed or stopped merge, only what that merge held is freed. The caches stay valid for the next one
+    cmn.loaded_checkpoints = None
+    gc.collect()
+    devices.torch_gc()
+    torch.cuda.empty_cache()
+
+
 #From https://github.com/hako-mikan/sd-webui-supermerger
 def fineman(fine,isxl):
     if fine.find(",") != -1:
@@ -1,10 +1,13 @@
 import gradio as gr
-import re,safetensors.torch,safetensors,torch,os,shutil
+import re,safetensors.torch,safetensors,torch,os,shutil,json,functools
 from collections import OrderedDict
 from modules.timer import Timer
-from modules import sd_models,script_callbacks,shared,sd_unet,sd_hijack,sd_models_config,paths_internal,processing,script_loading,paths,ui_common,images
+from modules import sd_models,script_callbacks,shared,sd_unet,sd_hijack,sd_models_config,paths_internal,processing,script_loading,paths,ui_common,images,devices
 
 import scripts.untitled.common as cmn
+import scripts.untitled.architectures as arch
+import scripts.untitled.recipe as recipe
+import scripts.untitled.reuse as reuse
 
 networks = script_loading.load_module(os.path.join(paths.extensions_builtin_dir,'Lora','networks.py'))
 
@@ -13,17 +16,12 @@ networks = script_loading.load_module(os.path.join(paths.extensions_builtin_dir,
 
 BASE_SELECTORS = {
     "all":  ".*",  # Adjusted to match anything
-    "clip": "cond.*",
-    "base": "cond.*",
-    "model_ema":  "model_ema.*",
-    "unet": "model\\.diffusion_model.*",
-    "in":   "model\\.diffusion_model\\.input_blocks.*",
-    "out":  "model\\.diffusion_model\\.output_blocks.*",
-    "mid":  "model\\.diffusion_model\\.middle_block.*"
+    **arch.SD_SELECTORS
 }
 
-def target_to_regex(target_input: str|list) -> str:
+def target_to_regex(target_input: str|list, selectors: dict|None = None) -> str:
     target_list = target_input if isinstance(target_input, list) else [target_input]
+    selectors = BASE_SELECTORS if selectors is None else {"all": ".*", **selectors}
 
     targets = []
     for target_name in target_list:
@@ -41,8 +39,8 @@ def target_to_regex(target_input: str|list) -> str:
             regex += ".*"  # Matches anything
         else:
             # Construct regex based on the processed input
-            if target_name in BASE_SELECTORS:
-                regex += BASE_SELECTORS[target_name]
+            if target_name in selectors:
+                regex += selectors[target_name]
             else:
                 regex += target_name
 
@@ -56,49 +54,35 @@ def target_to_regex(target_input: str|list) -> str:
 
     
 
-versions = {
-    "v1":'cond_stage_model.transformer.text_model.embeddings.token_embedding.weight',
-    "v2":'cond_stage_model.model.token_embedding.weight',
-    'xl':'conditioner.embedders.0.transformer.text_model.embeddings.token_embedding.weight'
-}
-
 def id_checkpoint(name):
     if not name: return None,None
-    filename = name if os.path.exists(name) else sd_models.get_closet_checkpoint_match(name).filename
-    with safetensors.torch.safe_open(filename,framework='pt',device='cpu') as st_file:
-
-        def gettensor(key):
-            try:
-                return st_file.get_tensor(key)
-            except safetensors.SafetensorError:
-                return None
-            
-        keys = st_file.keys()
-        
-        if versions['v1'] in keys:
-            diffusion_model_input = gettensor('model.diffusion_model.input_blocks.0.0.weight')
-            dtype = diffusion_model_input.dtype
-            if diffusion_model_input.shape[1] == 9:
-                return 'v1-inpainting',dtype
-            if diffusion_model_input.shape[1] == 8:
-                return 'v1-instruct-pix2pix',dtype
-            return 'v1',dtype
-        
-        if versions['xl'] in keys:
-            clip_embedder = gettensor('conditioner.embedders.1.model.ln_final.weight')
-            if clip_embedder is not None:
-                return 'SDXL',clip_embedder.dtype
-            return 'SDXL-refiner',gettensor('conditioner.embedders.1.model.ln_final.weight').dtype
-            
-        if versions['v2'] in keys:
-            diffusion_model_input = gettensor('model.diffusion_model.input_blocks.0.0.weight')
-            dtype = diffusion_model_input.dtype
-            if diffusion_model_input.shape[1] == 9:
-                return 'v2-inpainting',dtype
-            return 'v2',dtype
-            
-        
-        return 'Unknown',gettensor(keys[0]).dtype
+    probe = arch.probe(resolve_checkpoint(name))
+    return probe.name,getattr(torch,probe.dtype or 'float32')
+
+
+def resolve_checkpoint(name) -> str:
+    #Dropdown entries are either webui checkpoint titles or paths to sharded index files
+    if os.path.exists(name):
+        return name
+    sharded = os.path.join(checkpoints_dir(),name)
+    if arch.is_sharded(name) and os.path.exists(sharded):
+        return sharded
+    checkpoint_info = sd_models.get_closet_checkpoint_match(name.split(' ')[0])
+    return checkpoint_info.filename if checkpoint_info else None
+
+
+def checkpoints_dir() -> str:
+    return shared.cmd_opts.ckpt_dir or os.path.join(paths_internal.models_path, 'Stable-diffusion')
+
+
+def find_sharded_checkpoints() -> list:
+    found = []
+    root = checkpoints_dir()
+    for dirpath, _, filenames in os.walk(root,followlinks=True):
+        for filename in filenames:
+            if filename.endswith('.safetensors.index.json'):
+                found.append(os.path.relpath(os.path.join(dirpath,filename),root))
+    return sorted(found)
     
 
 class NoCaching:
@@ -130,38 +114,151 @@ def create_name(checkpoints,calcmode,alpha):
         
 
 def save_loaded_model(name,settings):
-    if shared.sd_model.sd_checkpoint_info.short_title != hash(cmn.last_merge_tasks):
+    if shared.sd_model.sd_checkpoint_info.short_title != cmn.last_merge_id:
         gr.Warning('Loaded model is not a unsaved merged model.')
         return
 
+    name = name or shared.sd_model.sd_checkpoint_info.name_for_extra.replace('_TEMP_MERGE_','')
+
+    #The merge is already on disk in the requested precision, move it into place
+    if cmn.last_merge_file and cmn.last_merge_file[1] == output_precision(settings):
+        filename = checkpoint_filename(name,settings)
+        try:
+            os.replace(cmn.last_merge_file[0],filename)
+            reuse.store.moved(cmn.last_merge_file[0],filename)
+            cmn.last_merge_file = None
+        except OSError: #Other drive, or the file is still mapped on Windows. The temp file is removed with the next merge
+            shutil.copyfile(cmn.last_merge_file[0],filename)
+        if cmn.last_merge_recipe:
+            recipe.save_sidecar(cmn.last_merge_recipe,filename)
+        checkpoint_info = sd_models.CheckpointInfo(filename)
+        checkpoint_info.register()
+        shared.sd_model.sd_checkpoint_info = checkpoint_info
+        shared.sd_model_file = filename
+        gr.Info('Model saved as '+filename)
+        return 'Model saved as: '+filename
+
+    #The merged tensors are still in the reuse store, write those instead of reading them back from the model
+    tensors = reuse.store.merge_tensors(cmn.last_merge_id)
+    if tensors is not None:
+        filename = checkpoint_filename(name,settings)
+        save_tensors_streaming(tensors.items(),filename,settings,cmn.last_merge_recipe)
+        checkpoint_info = sd_models.CheckpointInfo(filename)
+        checkpoint_info.register()
+        shared.sd_model.sd_checkpoint_info = checkpoint_info
+        shared.sd_model_file = filename
+        gr.Info('Model saved as '+filename)
+        return 'Model saved as: '+filename
+
     sd_unet.apply_unet("None")
     sd_hijack.model_hijack.undo_hijack(shared.sd_model)
 
+    #Only modules that currently hold a LoRA backup need restoring
     with torch.no_grad():
         for module in shared.sd_model.modules():
-            networks.network_restore_weights_from_backup(module)
-
-    state_dict = shared.sd_model.state_dict()
-
-    name = name or shared.sd_model.sd_checkpoint_info.name_for_extra.replace('_TEMP_MERGE_','')
+            if getattr(module,'network_weights_backup',None) is not None or getattr(module,'network_bias_backup',None) is not None:
+                networks.network_restore_weights_from_backup(module)
 
-    checkpoint_info = save_state_dict(state_dict,name,settings)
+    filename = checkpoint_filename(name,settings)
+    with torch.no_grad():
+        save_tensors_streaming(model_tensors(shared.sd_model),filename,settings,cmn.last_merge_recipe)
+    checkpoint_info = sd_models.CheckpointInfo(filename)
+    checkpoint_info.register()
+    gr.Info('Model saved as '+filename)
     shared.sd_model.sd_checkpoint_info = checkpoint_info
     shared.sd_model_file = checkpoint_info.filename
     return 'Model saved as: '+checkpoint_info.filename
 
 
-def save_state_dict(state_dict,name,settings,timer=None):
-    global recently_saved
-    if 'fp16' in settings:
+### TEMP OUTPUT
+TEMP_DIR = 'temp'
+
+def output_precision(settings) -> str:
+    for precision in ('fp8','fp16','bf16'):
+        if precision in settings:
+            return precision
+    return ''
+
+
+def save_temp_state_dict(state_dict,name,settings,merge_recipe=None) -> str:
+    #Writes the merge to the data folder so saving it later is usually a rename, replaces the previous temp file
+    discard_temp_checkpoint()
+    filename = os.path.join(cmn.data_dir(TEMP_DIR),name[0:200]+'.safetensors')
+
+    precision = output_precision(settings)
+    dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(precision)
+    if dtype:
+        for key,tensor in state_dict.items():
+            state_dict[key] = tensor.type(dtype)
+    metadata = {recipe.METADATA_KEY: recipe.to_metadata(merge_recipe)} if merge_recipe else None
+
+    safetensors.torch.save_file({key: tensor.contiguous() for key,tensor in state_dict.items()},filename,metadata=metadata)
+    cmn.last_merge_file = (filename,'' if precision == 'fp8' else precision)
+    return filename
+
+
+def discard_temp_checkpoint():
+    #Removes the previous temp merge, and any earlier one whose removal failed
+    current = cmn.last_merge_file[0] if cmn.last_merge_file else None
+    cmn.last_merge_file = None
+    directory = cmn.data_dir(TEMP_DIR)
+    for filename in os.listdir(directory):
+        filename = os.path.join(directory,filename)
+        try:
+            os.remove(filename)
+        except OSError as error: #Still mapped on Windows, retried next time
+            print(f'Could not remove temp merge {filename}: {error}')
+            if filename == current:
+                gr.Warning('Could not remove the previous temp merge, it will be removed later: '+filename)
+
+
+def model_tensors(model):
+    #Same keys as model.state_dict() without building it
+    for prefix,module in model.named_modules():
+        prefix = prefix + '.' if prefix else ''
+        for key,parameter in module._parameters.items():
+            if parameter is not None:
+                yield prefix+key, parameter
+        for key,buffer in module._buffers.items():
+            if buffer is not None and key not in module._non_persistent_buffers_set:
+                yield prefix+key, buffer
+
+
+def save_tensors_streaming(named_tensors,filename,settings,merge_recipe=None):
+    #Converts and writes one tensor at a time instead of converting a full state dict first
+    dtype = torch.bfloat16 if 'bf16' in settings else torch.float16 if 'fp16' in settings else None
+    entries = []
+    scales = {}
+    for key,tensor in named_tensors:
+        target = dtype if dtype and tensor.is_floating_point() else tensor.dtype
+        produce = lambda tensor=tensor: tensor
+        if 'fp8' in settings and tensor.is_floating_point() and tensor.dim() >= 2:
+            amax = tensor.detach().abs().max().float().item()
+            scale = scales[key] = amax / FP8_MAX if amax > 0 else 1.0
+            target = torch.float8_e4m3fn
+            produce = lambda tensor=tensor,scale=scale: (tensor.float() / scale).clamp(-FP8_MAX,FP8_MAX)
+        entries.append((key,tuple(tensor.shape),target,produce))
+
+    metadata = {}
+    if scales:
+        metadata[FP8_SCALES_KEY] = json.dumps(scales)
+    if merge_recipe:
+        metadata[recipe.METADATA_KEY] = recipe.to_metadata(merge_recipe)
+        recipe.save_sidecar(merge_recipe,filename)
+    arch.write_safetensors(filename,entries,metadata or None)
+
+
+def checkpoint_filename(name,settings) -> str:
+    if 'fp8' in settings:
+        fileext = ".fp8.safetensors"
+    elif 'fp16' in settings:
         fileext = ".fp16.safetensors"
     elif 'bf16' in settings:
         fileext = ".bf16.safetensors"
     else:
         fileext = '.safetensors'
 
-    checkpoint_dir = shared.cmd_opts.ckpt_dir or os.path.join(paths_internal.models_path, 'Stable-diffusion')
-    filename_no_ext = os.path.join(checkpoint_dir, name)
+    filename_no_ext = os.path.join(checkpoints_dir(), name)
     try:
         filename_no_ext = filename_no_ext[0:225]
     except: pass
@@ -172,6 +269,12 @@ def save_state_dict(state_dict,name,settings,timer=None):
         while os.path.exists(filename):
             filename = f"{filename_no_ext}_{n}{fileext}"
             n+=1
+    return filename
+
+
+def save_state_dict(state_dict,name,settings,timer=None,merge_recipe=None):
+    global recently_saved
+    filename = checkpoint_filename(name,settings)
 
     if 'fp16' in settings:
         for key,tensor in state_dict.items():
@@ -181,13 +284,26 @@ def save_state_dict(state_dict,name,settings,timer=None):
         for key,tensor in state_dict.items():
             state_dict[key] = tensor.type(torch.bfloat16)
 
+    #fp8 output is written from a quantized copy so the merged model can still be loaded at full precision
+    metadata = {}
+    to_save = state_dict
+    if 'fp8' in settings:
+        to_save, scales = quantize_fp8(state_dict)
+        metadata[FP8_SCALES_KEY] = json.dumps(scales)
+
+    if merge_recipe:
+        metadata[recipe.METADATA_KEY] = recipe.to_metadata(merge_recipe)
+        recipe.save_sidecar(merge_recipe,filename)
+    metadata = metadata or None
+
     try:
-        safetensors.torch.save_file(state_dict,filename)
+        safetensors.torch.save_file(to_save,filename,metadata=metadata)
     except safetensors.SafetensorError:
         print('Failed to save checkpoint. Applying contiguous to tensors and trying again...')
-        for key,tensor in state_dict.items():
-            state_dict[key] = tensor.contiguous()
-        safetensors.torch.save_file(state_dict,filename)
+        for key,tensor in to_save.items():
+            to_save[key] = tensor.contiguous()
+        safetensors.torch.save_file(to_save,filename,metadata=metadata)
+    del to_save
 
     try:
         timer.record('Save checkpoint')
@@ -200,11 +316,89 @@ def save_state_dict(state_dict,name,settings,timer=None):
     return checkpoint_info
 
 
+def save_lora(state_dict,name,metadata):
+    lora_dir = getattr(shared.cmd_opts,'lora_dir',None) or os.path.join(paths_internal.models_path,'Lora')
+    filename_no_ext = os.path.join(lora_dir, name)[0:225]
+    filename = filename_no_ext+'.safetensors'
+    n = 1
+    while os.path.exists(filename):
+        filename = f"{filename_no_ext}_{n}.safetensors"
+        n+=1
+
+    safetensors.torch.save_file(state_dict,filename,metadata=metadata)
+    gr.Info('LoRA saved as '+filename)
+    return filename
+
+
+### FP8
+FP8_SCALES_KEY = 'untitled_fp8_scales'
+FP8_MAX = 448.0 #Largest finite value of float8_e4m3fn
+
+def quantize_fp8(state_dict) -> tuple[dict,dict]:
+    #Weights with 2+ dims are stored as float8 with a per-tensor scale, norms, biases and integer buffers are left untouched
+    quantized = {}
+    scales = {}
+    for key,tensor in state_dict.items():
+        if not tensor.is_floating_point() or tensor.dim() < 2:
+            quantized[key] = tensor
+            continue
+        amax = tensor.detach().abs().max().float().item()
+        scale = amax / FP8_MAX if amax > 0 else 1.0
+        quantized[key] = (tensor.float() / scale).clamp(-FP8_MAX,FP8_MAX).to(torch.float8_e4m3fn)
+        scales[key] = scale
+    return quantized,scales
+
+
+def dequantize_fp8(tensor,scale,dtype) -> torch.Tensor:
+    return (tensor.to(torch.float32) * scale).to(dtype)
+
+
+def read_fp8_scales(st_file) -> dict:
+    metadata = st_file.metadata() or {}
+    try:
+        return json.loads(metadata[FP8_SCALES_KEY])
+    except (KeyError,ValueError):
+        return {}
+
+
+def file_fp8_scales(filename) -> dict:
+    if not str(filename).endswith('.safetensors'):
+        return {}
+    try:
+        metadata = arch.read_header_metadata(filename)[1]
+        return json.loads(metadata[FP8_SCALES_KEY])
+    except (OSError,KeyError,ValueError):
+        return {}
+
+
+def read_state_dict_fp8(read_state_dict):
+    #Wraps the webui's read_state_dict so fp8 checkpoints saved by this extension are dequantized however the webui loads them
+    @functools.wraps(read_state_dict)
+    def inner(checkpoint_file,*args,**kwargs):
+        state_dict = read_state_dict(checkpoint_file,*args,**kwargs)
+        scales = file_fp8_scales(checkpoint_file)
+        missing = 0
+        for key,scale in scales.items():
+            if key in state_dict:
+                state_dict[key] = dequantize_fp8(state_dict[key],scale,devices.dtype)
+            else:
+                missing += 1
+        if missing:
+            print(f'{missing} fp8 scales of {os.path.basename(checkpoint_file)} did not match a key, those weights are loaded unscaled')
+        return state_dict
+    inner.untitled_fp8 = True
+    return inner
+
+if not getattr(sd_models.read_state_dict,'untitled_fp8',False):
+    sd_models.read_state_dict = read_state_dict_fp8(sd_models.read_state_dict)
+
+
 def load_merged_state_dict(state_dict,checkpoint_info):
     config = sd_models_config.find_checkpoint_config(state_dict, checkpoint_info)
     
     for key, weight in state_dict.items():
-        state_dict[key] = weight.half()
+        if weight.is_floating_point():
+            state_dict[key] = weight.to(devices.dtype)
 
     if shared.sd_model and shared.sd_model.used_config == config:
         print('Loading weights using already loaded model...')
@@ -1,34 +1,60 @@
 import torch,scipy
 import scripts.untitled.common as cmn
+import scripts.untitled.rng as rng
+import scripts.untitled.lowrank as lowrank
+import scripts.untitled.events as events
+import scripts.untitled.architectures as arch
 import torch.nn.functional as F
 import numpy as np
 from collections import OrderedDict
+import weakref,threading
 
 
 def recurse(operation):
+    if isinstance(operation,Reduce): #Folds its sources in one at a time instead of loading them all first
+        return operation.reduce()
+
     source_tensors = []
     for source_oper in operation.sources:
         source_tensor = source_oper.merge()
         source_tensors.append(source_tensor)
 
+    cmn.check_stop()
     return operation.oper(*source_tensors)
 
 def cache_operation(func):
     def inner(operation):
         try:
-            return weights_cache[operation]
+            result = weights_cache[operation]
+            events.count('cache_hits')
+            return result
         except KeyError:pass
 
+        events.count('cache_misses')
         result = func(operation)
 
         weights_cache[operation] = result
         return result
     return inner
 
+cached_recurse = cache_operation(recurse)
+
+
+#Hash-consing: structurally equal operations are interned to a single node, so equality is identity and the
+#structural hash is computed once, from the already computed hashes of the sources.
+interned_operations = weakref.WeakValueDictionary()
+interned_lock = threading.Lock()
+
+class OperationMeta(type):
+    def __call__(cls,*args,**kwargs):
+        return super().__call__(*args,**kwargs).intern()
+
 
 ###OPERATORS####
 
-class Operation:
+class Operation(metaclass=OperationMeta):
+    __slots__ = ('key','sources','alpha','beta','gamma','delta','seed','merge_func','structural_hash','__weakref__')
+
     def __init__(self,key,*sources):
         self.key = key
         self.sources = tuple(sources)
@@ -39,35 +65,95 @@ class Operation:
         self.seed = None
         self.merge_func = recurse
 
+    def intern(self):
+        signature = (type(self), self.key, self.alpha, self.beta, self.gamma, self.delta, self.seed, self.sources)
+        with interned_lock:
+            canonical = interned_operations.get(signature)
+            if canonical is None:
+                self.structural_hash = hash(signature)
+                interned_operations[signature] = canonical = self
+        return canonical
+
     def __eq__(self, other):
-        return (self.key, self.alpha, self.beta, self.gamma, self.delta, self.seed, self.sources) == (other.key, other.alpha, other.beta, other.gamma, other.delta, other.seed, other.sources)
+        return self is other
     
     def __hash__(self):
-        return hash((self.key, self.alpha, self.beta, self.gamma, self.delta, self.seed, self.sources))
+        return self.structural_hash
     
     def oper(self,*args) -> torch.Tensor:
         raise NotImplementedError
 
     def merge(self):
         return self.merge_func(self)
+
+    def build(self):
+        return self
+
+    def replace_sources(self,*sources):
+        operation = type(self).__new__(type(self))
+        for attr in ('key','alpha','beta','gamma','delta','seed','merge_func'):
+            setattr(operation,attr,getattr(self,attr))
+        operation.sources = tuple(sources)
+        return operation.intern()
     
     def cache(self):
         if cmn.opts['cache_size'] > 512:
-            self.merge_func = cache_operation(recurse)
+            self.merge_func = cached_recurse
         return self
         
 
 class LoadTensor(Operation):
+    __slots__ = ()
+
     def __init__(self,key,alpha):
         super().__init__(key,*tuple())
         self.alpha = alpha
 
     #loadtensor uses merge instead of oper as it has no model inputs, use oper everywhere else 
     def merge(self) -> torch.Tensor:
-        return cmn.loaded_checkpoints[self.alpha].get_tensor(self.key).to(cmn.device())
+        return load_tensor(self.alpha,self.key)
+
+
+class LoadAligned(LoadTensor):
+    __slots__ = ()
+
+    #Loads key beta of a secondary model and conforms it to the primary model's shape gamma
+    def __init__(self,key,alpha,beta,gamma):
+        super().__init__(key,alpha)
+        self.beta = beta
+        self.gamma = tuple(gamma)
+
+    def merge(self) -> torch.Tensor:
+        return conform_tensor(load_tensor(self.alpha,self.beta),self.gamma)
+
+
+def load_tensor(checkpoint,key) -> torch.Tensor:
+    cmn.check_stop()
+    tensor = read_cache.get_tensor(checkpoint,key)
+    cached = tensor is not None
+    if not cached:
+        tensor = cmn.loaded_checkpoints[checkpoint].get_tensor(key)
+        events.count('bytes_read',tensor.nbytes)
+    scale = cmn.checkpoints_scales.get(checkpoint,{}).get(key)
+    if scale is not None: #Scaled fp8 checkpoint, dequantize to the merge dtype
+        return (tensor.to(cmn.device(),torch.float32) * scale).to(cmn.dtype())
+    return tensor.to(cmn.device(),copy=cached) #Cached tensors view the read cache's mapping, outputs shouldn't pin its pages
+
+
+def conform_tensor(tensor,shape) -> torch.Tensor:
+    if tensor.shape == shape:
+        return tensor
+    if tensor.numel() == np.prod(shape):
+        return tensor.reshape(shape)
+    out = torch.zeros(shape,dtype=tensor.dtype,device=tensor.device)
+    overlap = tuple(slice(0,min(a,b)) for a,b in zip(tensor.shape,shape))
+    out[overlap] = tensor[overlap]
+    return out
 
 
 class Multiply(Operation):
+    __slots__ = ()
+
     def __init__(self,key,alpha,*sources):
         super().__init__(key,*sources)
         self.alpha = alpha
@@ -77,14 +163,20 @@ class Multiply(Operation):
 
 
 class Add(Operation):
+    __slots__ = ()
+
     def __init__(self,*args):
         super().__init__(*args)
 
     def oper(self,a,b) -> torch.Tensor:
+        if isinstance(b,(SparseDelta,LowRankDelta)):
+            return b.add_to(a)
         return a + b
 
 
 class Sub(Operation):
+    __slots__ = ()
+
     def __init__(self,*args):
         super().__init__(*args)
 
@@ -93,43 +185,63 @@ class Sub(Operation):
 
 
 class Smooth(Operation):
+    __slots__ = ()
+
     def __init__(self,*args):
         super().__init__(*args)
 
+    #Rows past a tile that the filters read: 1 for the size 3 median, 4 for the sigma 1 gaussian (truncate 4)
+    HALO = 5
+
     ###From https://github.com/hako-mikan/sd-webui-supermerger
     def oper(self,a) -> torch.Tensor:
-        # Apply median filter to the differences
-        filtered_diff = scipy.ndimage.median_filter(a.detach().cpu().to(torch.float32).numpy(), size=3)
-        # Apply Gaussian filter to the filtered differences
-        filtered_diff = scipy.ndimage.gaussian_filter(filtered_diff, sigma=1)
-        return torch.tensor(filtered_diff,dtype=cmn.dtype(),device=cmn.device())
+        array = a.detach().cpu().to(torch.float32).numpy()
+        if array.ndim == 0:
+            return a.to(cmn.device(),cmn.dtype())
+        # Filtered in tiles of leading rows with a halo on both sides, so the result is the same as filtering
+        # the whole tensor while a stop only waits for the current tile
+        out = np.empty_like(array)
+        tile = max(1,cmn.chunk_size() // max(1,array[0].size))
+        for start in range(0,array.shape[0],tile):
+            cmn.check_stop()
+            end = min(start + tile,array.shape[0])
+            begin, stop = max(0,start - self.HALO), min(array.shape[0],end + self.HALO)
+            # Apply median filter to the differences
+            filtered_diff = scipy.ndimage.median_filter(array[begin:stop], size=3)
+            # Apply Gaussian filter to the filtered differences
+            filtered_diff = scipy.ndimage.gaussian_filter(filtered_diff, sigma=1)
+            out[start:end] = filtered_diff[start-begin:end-begin]
+        return torch.tensor(out,dtype=cmn.dtype(),device=cmn.device())
     
 
 class TrainDiff(Operation):
+    __slots__ = ()
+
     def __init__(self,*args):
         super().__init__(*args)
 
     ###From https://github.com/hako-mikan/sd-webui-supermerger
+    #(b - c) * |b - a| / (|b - c| + |b - a|) * 1.8, zero where both distances are zero.
+    #Computed in tiles with one float32 upcast of b per tile and in-place updates.
     def oper(self, a, b, c) -> torch.Tensor:
-        if torch.allclose(b.float(), c.float(), rtol=0, atol=0):
-            return torch.zeros_like(a)
-
-        diff_AB = b.float() - c.float()
-
-        distance_A0 = torch.abs(b.float() - c.float())
-        distance_A1 = torch.abs(b.float() - a.float())
-
-        sum_distances = distance_A0 + distance_A1
-
-        scale = torch.where(sum_distances != 0, distance_A1 / sum_distances, torch.tensor(0.).float())
-        sign_scale = torch.sign(b.float() - c.float())
-        scale = sign_scale * torch.abs(scale)
-
-        new_diff = scale * torch.abs(diff_AB)
-        return new_diff.to(cmn.dtype())  *1.8
+        out = torch.empty(a.shape,dtype=cmn.dtype(),device=a.device)
+        flat_a, flat_b, flat_c, flat_out = a.reshape(-1), b.reshape(-1), c.reshape(-1), out.view(-1)
+        tile = cmn.chunk_size()
+        for start in range(0,flat_out.numel(),tile):
+            cmn.check_stop()
+            end = start + tile
+            tb = flat_b[start:end].float()
+            diff = torch.sub(tb,flat_c[start:end])
+            scale = torch.sub(tb,flat_a[start:end]).abs_()
+            del tb
+            scale.div_(diff.abs().add_(scale)).nan_to_num_(0)
+            flat_out[start:end] = scale.mul_(diff).mul_(1.8)
+        return out
         
 
 class Extract(Operation):
+    __slots__ = ()
+
     def __init__(self,key,alpha,beta,gamma,*args):
         super().__init__(key,*args)
         self.alpha = alpha
@@ -144,16 +256,35 @@ class Extract(Operation):
         assert 0 <= self.beta <= 1
         assert 0 <= self.gamma
         dtype = base.dtype if base is not None else a.dtype
-        base = base.float() if base is not None else 0
-        a = a.float() - base
-        b = b.float() - base
-        c = torch.cosine_similarity(a, b, -1).clamp(-1, 1).unsqueeze(-1)
-        d = ((c + 1) / 2) ** self.gamma
-        result = torch.lerp(a, b, self.alpha) * torch.lerp(d, 1 - d, self.beta)
-        return result.to(dtype)
+        out = torch.empty(a.shape,dtype=dtype,device=a.device)
+
+        # The similarity is per row of the last dim, so rows are processed in tiles with in-place updates.
+        # Peak memory is the output plus a few float32 tiles instead of several full-size float32 copies.
+        width = a.shape[-1] if a.dim() else 1
+        rows = lambda x: x.reshape(-1,width)
+        a_rows, b_rows, out_rows = rows(a), rows(b), out.view(-1,width)
+        base_rows = rows(base) if base is not None else None
+        tile = max(1,cmn.chunk_size() // width)
+        for start in range(0,a_rows.shape[0],tile):
+            cmn.check_stop()
+            end = start + tile
+            ta = a_rows[start:end].to(torch.float32,copy=True)
+            tb = b_rows[start:end].to(torch.float32,copy=True)
+            if base_rows is not None:
+                tbase = base_rows[start:end].float()
+                ta.sub_(tbase)
+                tb.sub_(tbase)
+                del tbase
+            c = torch.cosine_similarity(ta, tb, -1).clamp_(-1, 1).unsqueeze_(-1)
+            d = ((c + 1) / 2) ** self.gamma
+            ta.lerp_(tb, self.alpha).mul_(torch.lerp(d, 1 - d, self.beta))
+            out_rows[start:end] = ta
+        return out
     
 
 class Similarities(Extract):
+    __slots__ = ()
+
     def __init__(self,*args):
         super().__init__(*args)
 
@@ -162,6 +293,8 @@ class Similarities(Extract):
 
 
 class PowerUp(Operation):
+    __slots__ = ()
+
     def __init__(self,key,alpha, seed, *sources):
         super().__init__(key,*sources)
         self.alpha = alpha
@@ -171,14 +304,21 @@ class PowerUp(Operation):
     #https://arxiv.org/pdf/2311.03099.pdf
     #https://github.com/yule-BUAA/MergeLM/tree/main/model_merging_methods
     def oper(self, a, b):
-        # Calculate the delta of the weights
         a, b = resize_tensors(a, b)
+        if self.alpha >= 1: #Everything dropped
+            return torch.zeros_like(a)
+
+        # alpha is the dropout rate. At high rates only the kept entries are gathered, the mask is identical to the dense path
+        if 1 - self.alpha < SPARSE_THRESHOLD:
+            indices = rng.KeyRNG(self.seed,self.key,'PowerUp').sample_indices(a.numel(),self.alpha,a.device)
+            values = (b.reshape(-1)[indices] - a.reshape(-1)[indices]) / (1 - self.alpha)
+            return SparseDelta(indices,values,a.shape)
+
+        # Calculate the delta of the weights
         delta = b - a
 
-        # Generate the mask m^t from Bernoulli distribution
-        rngenerator = torch.Generator(device=cmn.device())
-        rngenerator.manual_seed(self.seed)
-        m = torch.empty_like(delta,device=cmn.device(),dtype=cmn.dtype()).uniform_(0,1,generator=rngenerator) < self.alpha
+        # Generate the mask m^t from Bernoulli distribution, entries are kept with probability 1 - alpha
+        m = rng.KeyRNG(self.seed,self.key,'PowerUp').uniform(delta.shape,delta.device) >= self.alpha
 
         # Apply the mask to the delta to get δ̃^t
         delta_tilde = m * delta
@@ -188,6 +328,87 @@ class PowerUp(Operation):
         return delta_hat
     
 
+#Fraction of kept entries below which deltas are stored as index/value pairs
+SPARSE_THRESHOLD = 0.25
+
+class SparseDelta:
+    #Flat index/value representation of a mostly-zero delta, scatter-added into the target tensor
+    def __init__(self,indices,values,shape):
+        self.indices = indices
+        self.values = values
+        self.shape = torch.Size(shape)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+    def __mul__(self,scalar):
+        return SparseDelta(self.indices,self.values*scalar,self.shape)
+    __rmul__ = __mul__
+
+    def add_to(self,tensor) -> torch.Tensor:
+        assert tensor.shape == self.shape
+        values = self.values.to(tensor.device,tensor.dtype)
+        return tensor.reshape(-1).index_add(0,self.indices.to(tensor.device),values).view(self.shape)
+
+    def to_dense(self) -> torch.Tensor:
+        return self.add_to(torch.zeros(self.shape,dtype=self.values.dtype,device=self.values.device))
+
+    def detach(self):
+        return SparseDelta(self.indices.detach(),self.values.detach(),self.shape)
+
+    def cpu(self):
+        return self.to('cpu')
+
+    def clone(self):
+        return SparseDelta(self.indices.clone(),self.values.clone(),self.shape)
+
+    def to(self,device,dtype=None):
+        return SparseDelta(self.indices.to(device),self.values.to(device,dtype),self.shape)
+
+    def type(self,dtype):
+        return SparseDelta(self.indices,self.values.type(dtype),self.shape)
+
+
+class LowRankDelta:
+    #Delta stored as up @ down factors, only expanded when it is added to the target tensor
+    def __init__(self,up,down,shape):
+        self.up = up
+        self.down = down
+        self.shape = torch.Size(shape)
+
+    @property
+    def nbytes(self):
+        return self.up.nbytes + self.down.nbytes
+
+    def __mul__(self,scalar):
+        return LowRankDelta(self.up*scalar,self.down,self.shape)
+    __rmul__ = __mul__
+
+    def add_to(self,tensor) -> torch.Tensor:
+        assert tensor.shape == self.shape
+        product = self.up.to(tensor.device,torch.float32) @ self.down.to(tensor.device,torch.float32)
+        return tensor + product.view(self.shape).to(tensor.dtype)
+
+    def to_dense(self) -> torch.Tensor:
+        return (self.up.float() @ self.down.float()).view(self.shape)
+
+    def detach(self):
+        return LowRankDelta(self.up.detach(),self.down.detach(),self.shape)
+
+    def cpu(self):
+        return self.to('cpu')
+
+    def clone(self):
+        return LowRankDelta(self.up.clone(),self.down.clone(),self.shape)
+
+    def to(self,device,dtype=None):
+        return LowRankDelta(self.up.to(device,dtype),self.down.to(device,dtype),self.shape)
+
+    def type(self,dtype):
+        return LowRankDelta(self.up.type(dtype),self.down.type(dtype),self.shape)
+
+
 def resize_tensors(tensor1, tensor2):
     if len(tensor1.shape) not in [1, 2]:
         return tensor1, tensor2
@@ -211,7 +432,47 @@ def resize_tensors(tensor1, tensor2):
     return tensor1, tensor2
 
 
+def interpolate_difference(a,b,exponent,gamma,generator,invert=True,mask=None) -> torch.Tensor:
+    #Shared kernel of the InterpolateDifference family. |a - b| is reduced once for its max, then one buffer is
+    #normalized, masked, raised to exponent and mixed with a bernoulli draw of itself by gamma, all in place.
+    #mask(weights) receives the normalized weights before the power is applied.
+    dtype = torch.promote_types(a.dtype,b.dtype)
+    if exponent == 0 and mask is None: #Every weight is 1
+        return b.to(dtype)
+
+    weights = torch.sub(a,b).abs_()
+    maximum = weights.max()
+    if invert:
+        weights.neg_().add_(maximum)
+    weights.div_(maximum).nan_to_num_()
+
+    selected = mask(weights) if mask is not None else None
+    if exponent == 0:
+        weights.fill_(1)
+    elif exponent != 1:
+        weights.pow_(exponent).nan_to_num_()
+    if selected is not None:
+        weights.mul_(selected)
+        del selected
+
+    if gamma != 1:
+        draw = generator.bernoulli(weights)
+        if gamma == 0:
+            weights = draw
+        else:
+            weights.sub_(draw).mul_(gamma).add_(draw)
+        del draw
+
+    return torch.lerp(a.to(dtype),b.to(dtype),weights)
+
+
+def interpolation_exponent(alpha) -> float:
+    return 1 / max(alpha,0.001) - 1
+
+
 class InterpolateDifference(Operation):
+    __slots__ = ()
+
     def __init__(self,key,alpha,beta,gamma,seed,*sources):
         super().__init__(key,*sources)
         self.alpha = alpha
@@ -220,27 +481,12 @@ class InterpolateDifference(Operation):
         self.seed = seed
 
     def oper(self, a, b):
-        alpha = max(self.alpha,0.001)
-
-        delta = torch.abs(a - b)
-
-        if self.beta != 1:
-            diff = ((torch.max(delta) - delta) / torch.max(delta)) ** (1 / alpha - 1)
-        else:
-            diff = (delta / torch.max(delta)) ** (1 / alpha - 1)
-
-        diff = torch.nan_to_num(diff)
-
-        rngenerator = torch.Generator(device=diff.device)
-        rngenerator.manual_seed(self.seed)
-        bitmask = torch.bernoulli(torch.clamp(diff,0,1),out=torch.empty_like(diff),generator=rngenerator)
-
-        interpolated_mask = torch.lerp(bitmask, diff, self.gamma)
-
-        res = a * (1 - interpolated_mask) + b * interpolated_mask
-        return res
+        generator = rng.KeyRNG(self.seed,self.key,'InterpolateDifference')
+        return interpolate_difference(a,b,interpolation_exponent(self.alpha),self.gamma,generator,invert=self.beta != 1)
 
 class ManualEnhancedInterpolateDifference(Operation):
+    __slots__ = ()
+
     def __init__(self, key, alpha, beta, gamma, delta, seed, *sources):
         super().__init__(key, *sources)
         self.alpha = alpha  # Interpolation strength
@@ -250,40 +496,17 @@ class ManualEnhancedInterpolateDifference(Operation):
         self.seed = seed    # Seed for random number generation
 
     def oper(self, a, b):
-        # Calculate absolute differences
-        delta = torch.abs(a - b)
-        
-        # Normalize differences
-        diff = (torch.max(delta) - delta) / torch.max(delta)
-        diff = torch.nan_to_num(diff)
-        
-        # Calculate mean differences
-        mean_diff = torch.mean(diff, 0, keepdim=True)
-        
-        # Create mask based on mean differences
-        mask = torch.logical_and(self.beta < mean_diff, mean_diff < self.gamma)
-        
-        # Apply power function to differences
-        powered_diff = diff ** (1 / max(self.alpha, 0.001) - 1)
-        powered_diff = torch.nan_to_num(powered_diff)
-        
-        # Apply mask to powered differences
-        masked_diff = powered_diff * mask.float()
-        
-        # Generate random mask
-        rng = torch.Generator(device=a.device)
-        rng.manual_seed(self.seed)
-        random_mask = torch.bernoulli(torch.clamp(masked_diff, 0, 1), generator=rng)
-        
-        # Interpolate between random mask and powered differences
-        interpolated_mask = torch.lerp(random_mask, masked_diff, self.delta)
-        
-        # Apply final interpolation
-        result = a * (1 - interpolated_mask) + b * interpolated_mask
-        
-        return result
+        # Columns whose mean normalized difference is between the thresholds
+        def mask(diff):
+            mean_diff = torch.mean(diff, 0, keepdim=True)
+            return torch.logical_and(self.beta < mean_diff, mean_diff < self.gamma)
+
+        generator = rng.KeyRNG(self.seed, self.key, 'ManualEnhancedInterpolateDifference')
+        return interpolate_difference(a, b, interpolation_exponent(self.alpha), self.delta, generator, mask=mask)
 
 class AutoEnhancedInterpolateDifference(Operation):
+    __slots__ = ()
+
     def __init__(self, key, alpha, beta, gamma, seed, *sources):
         super().__init__(key, *sources)
         self.alpha = alpha  # Interpolation strength
@@ -292,77 +515,147 @@ class AutoEnhancedInterpolateDifference(Operation):
         self.seed = seed    # Seed for random number generation
 
     def oper(self, a, b):
-        # Calculate absolute differences
-        delta = torch.abs(a - b)
-        
-        # Normalize differences
-        max_delta = torch.max(delta)
-        diff = (max_delta - delta) / max_delta
-        diff = torch.nan_to_num(diff)
-        
-        # Calculate mean differences
-        mean_diff = torch.mean(diff)
-        
-        # Dynamically set lower and upper thresholds
-        lower_threshold = mean_diff * (1 - self.beta)
-        upper_threshold = mean_diff * (1 + self.beta)
-        
-        # Create mask based on dynamic thresholds
-        mask = torch.logical_and(lower_threshold < diff, diff < upper_threshold)
-        
-        # Apply power function to differences
-        powered_diff = diff ** (1 / max(self.alpha, 0.001) - 1)
-        powered_diff = torch.nan_to_num(powered_diff)
-        
-        # Apply mask to powered differences
-        masked_diff = powered_diff * mask.float()
-        
-        # Generate random mask
-        rng = torch.Generator(device=a.device)
-        rng.manual_seed(self.seed)
-        random_mask = torch.bernoulli(torch.clamp(masked_diff, 0, 1), generator=rng)
-        
-        # Interpolate between random mask and powered differences
-        interpolated_mask = torch.lerp(random_mask, masked_diff, self.gamma)
-        
-        # Apply final interpolation
-        result = a * (1 - interpolated_mask) + b * interpolated_mask
-        
-        return result
+        # Values within beta of the mean normalized difference
+        def mask(diff):
+            mean_diff = torch.mean(diff)
+            return torch.logical_and(mean_diff * (1 - self.beta) < diff, diff < mean_diff * (1 + self.beta))
+
+        generator = rng.KeyRNG(self.seed, self.key, 'AutoEnhancedInterpolateDifference')
+        return interpolate_difference(a, b, interpolation_exponent(self.alpha), self.gamma, generator, mask=mask)
 
-#class SingularValueDeOperator(Operation):
-#    def __init__(self, key, alpha, beta, seed, *sources):
-#        super().__init__(key, *sources)
-#        self.alpha = alpha  # threshold for significant singular values
-#        self.beta = beta    # used to determine which singular values to keep
-#
-#    def oper(self, a, b):
-#        assert a.shape == b.shape, "Tensors must have the same shape"
-#
-#        diff = a - b
-#        U, S, Vh = torch.linalg.svd(diff)
-#
-#        # Apply thresholding based on alpha
-#        significant_values = S > self.alpha
-#
-#        # Optionally keep only top k singular values based on beta
-#        if self.beta < 1:
-#            k = max(1, int(self.beta * len(S)))
-#            top_k_mask = torch.empty_like(significant_values)
-#            top_k_mask[:k] = True
-#            significant_values = significant_values & top_k_mask
-#
-#        # Reconstruct the difference using only significant singular values
-#        S_filtered = S * significant_values
-#        rng = torch.Generator(device=a.device)
-#        rng.manual_seed(self.seed)
-#        reconstructed_diff = torch.matmul(U, torch.matmul(torch.diag(S_filtered), Vh), generator=rng)
-#
-#        result = reconstructed_diff
-#        return result
+class LowRankDifference(Operation):
+    __slots__ = ()
+
+    def __init__(self,key,alpha,seed,*sources):
+        super().__init__(key,*sources)
+        self.alpha = alpha  # rank
+        self.seed = seed
+
+    def oper(self, b, c):
+        diff = b - c
+        if not lowrank.is_factorizable(self.key,diff.shape):
+            return diff
+        up, down = lowrank.factorize(diff,self.alpha,self.seed,self.key)
+        return LowRankDelta(up,down,diff.shape)
+
+
+### N-WAY
+class Reduce(Operation):
+    #Streams any number of models: each source is merged and folded into a running state, so only the state
+    #and one model's tensor are alive at a time. alpha holds the per-model weights, missing weights are 1.
+    __slots__ = ()
+
+    def reduce(self) -> torch.Tensor:
+        state = None
+        for n,source in enumerate(self.sources):
+            tensor = source.merge()
+            cmn.check_stop()
+            state = self.fold(state,n,tensor)
+        return self.finish(state)
+
+    def weight(self,n) -> float:
+        return self.alpha[n] if self.alpha and n < len(self.alpha) else 1.0
+
+    def fold(self,state,n,tensor):
+        raise NotImplementedError
+
+    def finish(self,state) -> torch.Tensor:
+        raise NotImplementedError
+
+
+class WeightedMean(Reduce):
+    __slots__ = ()
+
+    def __init__(self,key,alpha,*sources):
+        super().__init__(key,*sources)
+        self.alpha = tuple(alpha)
+
+    def fold(self,state,n,tensor):
+        weight = self.weight(n)
+        if state is None:
+            return {'dtype': tensor.dtype, 'total': tensor.float() * weight, 'weight': weight}
+        state['total'].add_(tensor.float(),alpha=weight)
+        state['weight'] += weight
+        return state
+
+    def finish(self,state) -> torch.Tensor:
+        return (state['total'] / (state['weight'] or 1)).to(state['dtype'])
+
+
+def trim_to_density(delta,density) -> torch.Tensor:
+    #Keeps the top density fraction of entries by magnitude
+    if density >= 1 or delta.numel() < 2:
+        return delta
+    k = max(1,int(delta.numel() * (1 - density)))
+    threshold = delta.abs().flatten().kthvalue(k).values
+    return delta * (delta.abs() > threshold)
+
+
+class TiesMerge(Reduce):
+    __slots__ = ()
+
+    #https://arxiv.org/abs/2306.01708 - the first source is the base, the others are trimmed to beta density,
+    #the sign with the larger total mass wins and the deltas that agree with it are averaged. gamma scales the result.
+    def __init__(self,key,alpha,beta,gamma,*sources):
+        super().__init__(key,*sources)
+        self.alpha = tuple(alpha)
+        self.beta = beta
+        self.gamma = gamma
+
+    def fold(self,state,n,tensor):
+        if state is None:
+            return {'base': tensor}
+        weight = self.weight(n-1)
+        delta = trim_to_density(tensor.float() - state['base'].float(),self.beta)
+        for sign,agrees in (('positive',delta > 0),('negative',delta < 0)):
+            if sign not in state:
+                state[sign] = torch.zeros_like(delta)
+                state[sign+'_weight'] = torch.zeros_like(delta)
+            state[sign].add_(delta * agrees,alpha=weight)
+            state[sign+'_weight'].add_(agrees.float(),alpha=weight)
+        return state
+
+    def finish(self,state) -> torch.Tensor:
+        base = state['base']
+        if 'positive' not in state:
+            return base
+        positive = state['positive'] / state['positive_weight'].clamp_min(1e-8)
+        negative = state['negative'] / state['negative_weight'].clamp_min(1e-8)
+        elected = torch.where(state['positive'] + state['negative'] >= 0,positive,negative)
+        return (base.float() + elected * self.gamma).to(base.dtype)
+
+
+class DareMerge(Reduce):
+    __slots__ = ()
+
+    #Multi-model DARE: every delta against the first source gets its own drop mask with rate beta and is rescaled,
+    #the masks come from disjoint ranges of one key stream. gamma scales the summed deltas.
+    def __init__(self,key,alpha,beta,gamma,seed,*sources):
+        super().__init__(key,*sources)
+        self.alpha = tuple(alpha)
+        self.beta = beta
+        self.gamma = gamma
+        self.seed = seed
+
+    def fold(self,state,n,tensor):
+        if state is None:
+            return {'base': tensor, 'delta': None}
+        delta = tensor.float() - state['base'].float()
+        keep = rng.KeyRNG(self.seed,self.key,'DareMerge').uniform(delta.shape,delta.device,offset=(n-1)*delta.numel()) >= self.beta
+        delta = delta * keep * (self.weight(n-1) / max(1 - self.beta,1e-8))
+        state['delta'] = delta if state['delta'] is None else state['delta'].add_(delta)
+        return state
+
+    def finish(self,state) -> torch.Tensor:
+        base = state['base']
+        if state['delta'] is None:
+            return base
+        return (base.float() + state['delta'] * self.gamma).to(base.dtype)
 
 
 class WeightSumCutoff(Operation):
+    __slots__ = ()
+
     def __init__(self,key,alpha, beta, gamma, *sources):
         super().__init__(key,*sources)
         self.alpha = alpha
@@ -370,43 +663,175 @@ class WeightSumCutoff(Operation):
         self.gamma = gamma
 
     def oper(self, a, b):
-        delta = torch.abs(a - b)
-
-        diff = (torch.max(delta) - delta) / torch.max(delta)
-        diffn = torch.nan_to_num(diff)
-
-        mean = torch.mean(diffn,0,True) 
+        if a.dim() == 0:
+            return a
+        delta = torch.sub(a,b).abs_()
+
+        # mean((max - delta) / max) over dim 0, without the full-size normalized copy
+        max_delta = delta.max()
+        mean = torch.nan_to_num((max_delta - torch.mean(delta,0,True)) / max_delta)
+        del delta
         mask = torch.logical_and(mean < self.beta,self.gamma < mean)
-        mul = self.alpha*mask
 
-        res = a * (1 - mul) + b * mul
+        # Only the selected columns are interpolated, everything else stays as a
+        columns = torch.nonzero(mask.reshape(-1)).squeeze(1)
+        res = a.clone(memory_format=torch.contiguous_format)
+        if columns.numel():
+            res_2d = res.view(a.shape[0],-1)
+            res_2d[:,columns] = torch.lerp(a.reshape(a.shape[0],-1)[:,columns],b.reshape(b.shape[0],-1)[:,columns].to(a.dtype),self.alpha)
         return res
 #The cache
-tensor_size = lambda x: x.element_size() * x.nelement()
+tensor_size = lambda x: x.nbytes
 
 class WeightsCache:
+    #Shared by all merge threads. Keys are spread over stripes that each have their own lock, LRU order and byte count,
+    #so threads only contend when their keys land in the same stripe. Entries too large for a stripe go to one shared
+    #overflow slot. Hits are returned as a copy made by one transfer to the merge device and dtype, so consumers may
+    #modify them in place without touching the cache.
+    STRIPES = 16
+    OVERFLOW = 0.25 #Share of the size cap kept for the overflow slot
+
     def __init__(self, size):
-        self.mapping = OrderedDict()
         self.size_cap = min(size, 8192)*1024*1024
-        self.size = 0
+        stripe_cap = int(self.size_cap * (1 - self.OVERFLOW)) // self.STRIPES
+        self.caps = [stripe_cap] * self.STRIPES + [self.size_cap - stripe_cap * self.STRIPES]
+        self.stripes = [(threading.Lock(),OrderedDict()) for _ in self.caps]
+        self.sizes = [0] * len(self.caps)
+        self.hits = [0] * len(self.caps)
+        self.misses = [0] * len(self.caps)
+        self.evictions = [0] * len(self.caps)
+        self.skipped = [0] * len(self.caps) #Entries larger than the overflow slot, never cached
 
     def __setitem__(self, key, t):
-        if key in self.mapping:
-            self.mapping.move_to_end(key)
-        else:
-            t = t.detach().cpu()
-            self.mapping[key] = t
-            self.size += tensor_size(t)
-            while self.size >= self.size_cap:
-                _ , tensor = self.mapping.popitem(last=False)
-                self.size -= tensor_size(tensor)
+        index = hash(key) % self.STRIPES
+        if tensor_size(t) > self.caps[index]:
+            index = self.STRIPES
+        lock, mapping = self.stripes[index]
+        if tensor_size(t) > self.caps[index]:
+            with lock:
+                self.skipped[index] += 1
+            return
+        t = t.detach().cpu()
+        with lock:
+            if key in mapping:
+                mapping.move_to_end(key)
+                return
+            mapping[key] = t
+            self.sizes[index] += tensor_size(t)
+            while self.sizes[index] > self.caps[index]:
+                _ , tensor = mapping.popitem(last=False)
+                self.sizes[index] -= tensor_size(tensor)
+                self.evictions[index] += 1
 
     def __getitem__(self, key: Operation) -> torch.Tensor:
-        t = self.mapping[key]
-        self.mapping.move_to_end(key)
-        return t.clone().to(cmn.device()).type(cmn.dtype())
+        stripe = hash(key) % self.STRIPES
+        for index in (stripe,self.STRIPES):
+            lock, mapping = self.stripes[index]
+            with lock:
+                t = mapping.get(key)
+                if t is not None:
+                    mapping.move_to_end(key)
+                    self.hits[index] += 1
+                    break
+        else:
+            with self.stripes[stripe][0]:
+                self.misses[stripe] += 1
+            raise KeyError(key)
+        #Shared with the cache unless the device or dtype differs, operators never modify their inputs in place
+        return t.to(cmn.device(),cmn.dtype()) #Also SparseDelta, LowRankDelta
+
+    def stats(self) -> dict:
+        return {'hits': sum(self.hits), 'misses': sum(self.misses), 'evictions': sum(self.evictions), 'skipped': sum(self.skipped),
+                'entries': sum(len(mapping) for _,mapping in self.stripes), 'bytes': sum(self.sizes)}
     
 
 weights_cache = WeightsCache(4096)
 
 
+class ReadCache:
+    #Raw tensors of the input checkpoints keyed by (file identity, key), so consecutive merges sharing a model don't read it again.
+    #The tensors are views of the mapped files, so the cache holds page cache rather than copies. Merges read the keys in the
+    #same order every time, so under LRU a model larger than the cap would lose every key before it is read again. Instead keys
+    #of models the running merge doesn't use are evicted first, and keys of the running merge are never displaced: once full,
+    #new keys are read from the open file and the head of each model stays cached.
+    def __init__(self, size):
+        self.size_cap = size*1024*1024
+        self.identities = {} #checkpoint: file identity, for the running merge
+        self.files = {} #file identity: (header, {filename: (mmap, buffer)})
+        self.mapping = OrderedDict() #(file identity, key): tensor
+        self.counts = {} #file identity: number of keys in mapping
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def prepare(self, checkpoints):
+        #Called before each merge. Mappings of files that changed since they were cached are dropped
+        identities = {checkpoint: arch.file_identity(checkpoint) for checkpoint in checkpoints if checkpoint} if self.size_cap > 0 else {}
+        paths = {identity[0]: identity for identity in identities.values()}
+        with self.lock:
+            self.identities = identities
+            for identity in [identity for identity in self.files if paths.get(identity[0],identity) != identity]:
+                for key in [key for key in self.mapping if key[0] == identity]:
+                    self.size -= self.mapping.pop(key).nbytes
+                self.counts.pop(identity,None)
+                del self.files[identity]
+            for identity in [identity for identity in self.files if not self.counts.get(identity) and identity not in paths.values()]:
+                del self.files[identity]
+
+    def get_tensor(self, checkpoint, key) -> torch.Tensor|None:
+        #None if the checkpoint isn't cached in this merge or the cache is full, the caller then reads from the open file
+        identity = self.identities.get(checkpoint)
+        if identity is None:
+            return None
+        with self.lock:
+            tensor = self.mapping.get((identity,key))
+            if tensor is not None:
+                self.mapping.move_to_end((identity,key))
+                events.count('read_cache_hits')
+                return tensor
+            if identity not in self.files:
+                header = arch.read_header(checkpoint)
+                self.files[identity] = (header,arch.map_files(header))
+            header, files = self.files[identity]
+            entry = header.get(key)
+            if entry is None:
+                return None
+            begin, end = entry['data_offsets']
+            if not self.reserve(end - begin):
+                return None
+        tensor = arch.tensor_view(files[entry['file']][1],entry,entry['start'])
+        events.count('bytes_read',tensor.nbytes)
+
+        with self.lock:
+            if (identity,key) in self.mapping or identity not in self.files: #Added by another thread, or dropped meanwhile
+                self.size -= tensor.nbytes
+            else:
+                self.mapping[(identity,key)] = tensor
+                self.counts[identity] = self.counts.get(identity,0) + 1
+        return tensor
+
+    def reserve(self, nbytes) -> bool:
+        #Makes room by evicting keys of models outside the running merge, least recently used first
+        active = set(self.identities.values())
+        for cache_key in [cache_key for cache_key in self.mapping if cache_key[0] not in active]:
+            if self.size + nbytes <= self.size_cap: break
+            self.remove(cache_key)
+        if self.size + nbytes > self.size_cap:
+            return False
+        self.size += nbytes
+        return True
+
+    def remove(self, cache_key):
+        identity, key = cache_key
+        self.size -= self.mapping.pop(cache_key).nbytes
+        header, files = self.files[identity]
+        entry = header[key]
+        arch.release_pages(files[entry['file']][0],entry)
+        self.counts[identity] -= 1
+        if self.counts[identity] == 0 and identity not in self.identities.values(): #Unmap files no merge is using
+            del self.counts[identity]
+            del self.files[identity]
+
+
+read_cache = ReadCache(0)
+
+
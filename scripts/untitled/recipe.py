@@ -0,0 +1,126 @@
+import json,hashlib,os,struct,zlib,base64
+import scripts.untitled.operators as opr
+
+#On-disk merge recipe: a deduplicated operation graph where every node is addressed by the hash of its
+#content (operator, key, parameters, source node ids, model identities).
+
+FORMAT = 'untitled-recipe'
+VERSION = 1
+METADATA_KEY = 'untitled_recipe'
+PARAMS = ('alpha','beta','gamma','delta','seed')
+
+def header_digest(filename) -> str:
+    if filename.endswith('.index.json'):
+        with open(filename,'rb') as file:
+            return hashlib.blake2b(file.read(),digest_size=16).hexdigest()
+    with open(filename,'rb') as file:
+        length = struct.unpack('<Q',file.read(8))[0]
+        return hashlib.blake2b(file.read(length),digest_size=16).hexdigest()
+
+
+def model_ref(filename,sha256=None) -> dict:
+    return {
+        'name': os.path.basename(filename),
+        'size': os.path.getsize(filename),
+        'sha256': sha256,
+        'header': header_digest(filename)
+    }
+
+
+def node_id(content) -> str:
+    return hashlib.blake2b(json.dumps(content,separators=(',',':')).encode(),digest_size=12).hexdigest()
+
+
+def build(tasks,checkpoints,calcmode,seed,finetune='',hashes=None) -> dict:
+    hashes = hashes or {}
+    checkpoints = [checkpoint for checkpoint in checkpoints if checkpoint]
+    models = [model_ref(checkpoint,hashes.get(checkpoint)) for checkpoint in checkpoints]
+    model_ids = {checkpoint: model['sha256'] or model['header'] for checkpoint,model in zip(checkpoints,models)}
+    model_index = {checkpoint: n for n,checkpoint in enumerate(checkpoints)}
+
+    keys = []
+    key_index = {}
+    nodes = {}
+    memo = {}
+
+    def visit(operation) -> str:
+        try:
+            return memo[operation]
+        except KeyError: pass
+
+        params = [list(value) if isinstance(value,tuple) else value for value in (getattr(operation,name) for name in PARAMS)]
+        sources = [visit(source) for source in operation.sources]
+        if isinstance(operation,opr.LoadTensor):
+            identity = model_ids[params[0]]
+            params[0] = model_index[params[0]]
+        else:
+            identity = None
+
+        nid = node_id([type(operation).__name__,operation.key,params,sources,identity])
+        if nid not in nodes:
+            if operation.key not in key_index:
+                key_index[operation.key] = len(keys)
+                keys.append(operation.key)
+            node = [type(operation).__name__,key_index[operation.key],params,sources]
+            if operation.merge_func is not opr.recurse:
+                node.append(1)
+            nodes[nid] = node
+        memo[operation] = nid
+        return nid
+
+    outputs = {task.key: visit(task.build()) for task in tasks}
+
+    return {
+        'format': FORMAT,
+        'version': VERSION,
+        'calcmode': calcmode,
+        'seed': seed,
+        'finetune': finetune,
+        'models': models,
+        'keys': keys,
+        'nodes': nodes,
+        'outputs': outputs
+    }
+
+
+def diff(recipe_a,recipe_b) -> dict:
+    #Keys whose output node differs, is missing or was added between two recipes
+    outputs_a, outputs_b = recipe_a['outputs'], recipe_b['outputs']
+    return {
+        'changed': [key for key,nid in outputs_b.items() if key in outputs_a and outputs_a[key] != nid],
+        'removed': [key for key in outputs_a if key not in outputs_b],
+        'added': [key for key in outputs_b if key not in outputs_a]
+    }
+
+
+def to_metadata(recipe) -> str:
+    return base64.b64encode(zlib.compress(json.dumps(recipe,separators=(',',':')).encode(),9)).decode()
+
+
+def from_metadata(metadata) -> dict|None:
+    try:
+        return json.loads(zlib.decompress(base64.b64decode(metadata[METADATA_KEY])))
+    except (KeyError,TypeError,ValueError,zlib.error):
+        return None
+
+
+def sidecar_path(filename) -> str:
+    return os.path.splitext(filename)[0] + '.recipe.json'
+
+
+def save_sidecar(recipe,filename):
+    with open(sidecar_path(filename),'w') as file:
+        json.dump(recipe,file,separators=(',',':'))
+
+
+def load_file(filename) -> dict|None:
+    #Sidecar first, then the recipe embedded in the safetensors metadata
+    try:
+        with open(sidecar_path(filename),'r') as file:
+            return json.load(file)
+    except FileNotFoundError: pass
+    if not filename.endswith('.safetensors'): return None
+    with open(filename,'rb') as file:
+        length = struct.unpack('<Q',file.read(8))[0]
+        header = json.loads(file.read(length))
+    return from_metadata(header.get('__metadata__',{}))
@@ -0,0 +1,147 @@
+import os,torch
+from collections import OrderedDict
+import scripts.untitled.common as cmn
+import scripts.untitled.operators as opr
+import scripts.untitled.recipe as recipe
+import scripts.untitled.architectures as arch
+
+#Merged tensors of the last few merges, keyed by a hash of the task's operation tree and the identities of the
+#files it reads. The hashes are stable across processes, and the store doesn't depend on the webui model,
+#so tweak-and-remerge keeps reusing unchanged keys after the model is unloaded. Tensors are kept in RAM up to
+#a budget, beyond that they are memory-mapped from the merge's output file, or from a spill file if the user opted in.
+#Mapped merges are dropped once their file changes, e.g. when a later save overwrites it.
+
+SPILL_DIR = 'reuse'
+
+def enabled() -> bool:
+    return int(cmn.opts['reuse_merges'] or 0) > 0
+
+
+class MergeLookup:
+    #Per merge: hashes each task where a worker builds it and looks the hash up in the store, so nothing
+    #is built up front. hashes and reused are filled in as tasks run
+    def __init__(self,checkpoints):
+        self.identities = {checkpoint: '|'.join(map(str,arch.file_identity(checkpoint))) for checkpoint in checkpoints if checkpoint}
+        self.dtype = cmn.dtype()
+        self.hashes = {}
+        self.reused = set()
+
+    def task_hash(self,operation) -> str:
+        memo = {}
+
+        def visit(operation) -> str:
+            try:
+                return memo[operation]
+            except KeyError: pass
+            params = [list(value) if isinstance(value,tuple) else value for value in (getattr(operation,name) for name in recipe.PARAMS)]
+            if isinstance(operation,opr.LoadTensor):
+                params[0] = self.identities[params[0]]
+            memo[operation] = recipe.node_id([type(operation).__name__,operation.key,params,[visit(source) for source in operation.sources]])
+            return memo[operation]
+
+        return recipe.node_id([visit(operation),str(self.dtype)])
+
+    def __call__(self,key,operation) -> torch.Tensor|None:
+        task_hash = self.hashes[key] = self.task_hash(operation)
+        if not store.merges: return None
+        tensor = store.lookup(task_hash,self.dtype)
+        if tensor is not None:
+            self.reused.add(key)
+        return tensor
+
+
+def merge_id(hashes) -> str:
+    return recipe.node_id(sorted(hashes.values()))
+
+
+class ReuseStore:
+    def __init__(self):
+        self.merges = OrderedDict() #merge id: {'tensors': {task hash: tensor}, 'keys': {key: task hash}, 'spill': filename, 'source': file identity, 'complete': bool}
+
+    def current(self,merge_id) -> dict|None:
+        #The stored merge, discarded if the file its tensors are mapped from was replaced or removed
+        merge = self.merges.get(merge_id)
+        if merge is None or merge['source'] is None:
+            return merge
+        try:
+            if arch.file_identity(merge['source'][0]) == merge['source']:
+                return merge
+        except OSError: pass
+        self.discard(merge_id)
+        return None
+
+    def lookup(self,task_hash,dtype) -> torch.Tensor|None:
+        #Tensors stored from a file saved at another precision than the merge dtype are not reused
+        for merge_id in reversed(list(self.merges)):
+            merge = self.current(merge_id)
+            if merge is None: continue
+            tensor = merge['tensors'].get(task_hash)
+            if tensor is not None and (tensor.dtype == dtype or not tensor.is_floating_point()):
+                return tensor
+        return None
+
+    def merge_tensors(self,merge_id) -> dict|None:
+        #{key: tensor} of a stored merge, None unless every key of it is stored
+        merge = self.current(merge_id)
+        if merge is None or not merge['complete']:
+            return None
+        return {key: merge['tensors'][task_hash] for key,task_hash in merge['keys'].items()}
+
+    def add(self,merge_id,state_dict,hashes,source=None,spill=True) -> bool:
+        #source: safetensors file with these results (temp output or autosave), mapped instead of keeping them in RAM.
+        #Without one the merge is only stored if it fits the RAM budget, or written to a spill file when enabled.
+        #Returns whether the merge was stored
+        merges_kept = int(cmn.opts['reuse_merges'] or 0)
+        if merges_kept < 1 or not hashes: return False
+        keys = {key: task_hash for key,task_hash in hashes.items() if key in state_dict}
+        ram_budget = int(cmn.opts['reuse_ram'] or 0)*1024*1024
+        spill_file = identity = None
+
+        if sum(state_dict[key].nbytes for key in keys) <= ram_budget:
+            tensors = {task_hash: state_dict[key].detach().to('cpu') for key,task_hash in keys.items()}
+        else:
+            if source is None:
+                if not spill or not cmn.opts['reuse_spill']: return False
+                source = spill_file = os.path.join(cmn.data_dir(SPILL_DIR),merge_id+'.safetensors')
+                entries = [(key,tuple(state_dict[key].shape),state_dict[key].dtype,lambda key=key: state_dict[key]) for key in keys]
+                arch.write_safetensors(spill_file,entries)
+            identity = arch.file_identity(source)
+            mapped = arch.mmap_state_dict(source)
+            tensors = {task_hash: mapped[key] for key,task_hash in keys.items() if key in mapped}
+
+        self.merges.pop(merge_id,None)
+        self.merges[merge_id] = {'tensors': tensors, 'keys': keys, 'spill': spill_file, 'source': identity, 'complete': len(tensors) == len(state_dict)}
+        while len(self.merges) > merges_kept:
+            self.discard(next(iter(self.merges)))
+        return True
+
+    def moved(self,filename,new_filename):
+        #A renamed file still backs the tensors mapped from it, only the recorded identity changes
+        path = os.path.abspath(filename)
+        for merge in self.merges.values():
+            if merge['source'] and merge['source'][0] == path:
+                merge['source'] = arch.file_identity(new_filename)
+
+    def discard(self,merge_id):
+        merge = self.merges.pop(merge_id,None) #May already be gone when workers find the same stale merge
+        if merge and merge['spill']:
+            try:
+                os.remove(merge['spill']) #Existing views keep the mapping alive
+            except OSError: pass
+
+    def clear(self):
+        while self.merges:
+            self.discard(next(iter(self.merges)))
+
+
+def remove_spills():
+    #Spill files left by an earlier session have no entry in the store, nothing would ever reuse or remove them
+    directory = cmn.data_dir(SPILL_DIR)
+    for name in os.listdir(directory):
+        try:
+            os.remove(os.path.join(directory,name))
+        except OSError: pass
+
+
+store = ReuseStore()
+remove_spills()
@@ -0,0 +1,65 @@
+import torch,hashlib
+import scripts.untitled.common as cmn
+
+#Counter-based random streams. Every value is a pure function of (seed, key, operator, element index),
+#computed with exact integer arithmetic, so the output is identical on any device and for any chunking.
+
+MASK32 = 0xffffffff
+
+def derive_seed(seed,key,operator) -> tuple[int,int]:
+    digest = hashlib.blake2b(f'{seed}|{key}|{operator}'.encode(),digest_size=8).digest()
+    return int.from_bytes(digest[:4],'little'), int.from_bytes(digest[4:],'little')
+
+
+def mul32(x,c) -> torch.Tensor:
+    #(x * c) mod 2**32 without leaving the int64 range
+    lo = x * (c & 0xffff)
+    hi = ((x * (c >> 16)) & 0xffff) << 16
+    return (lo + hi) & MASK32
+
+
+def hash32(x) -> torch.Tensor:
+    #murmur3 finalizer on uint32 values held in int64
+    x = x ^ (x >> 16)
+    x = mul32(x,0x85ebca6b)
+    x = x ^ (x >> 13)
+    x = mul32(x,0xc2b2ae35)
+    return x ^ (x >> 16)
+
+
+class KeyRNG:
+    def __init__(self,seed,key,operator):
+        self.s1, self.s2 = derive_seed(seed,key,operator)
+
+    def uniform_range(self,start,count,device) -> torch.Tensor:
+        #Values [start,start+count) of the flat stream as float32 in [0,1)
+        x = torch.arange(start,start+count,dtype=torch.int64,device=device)
+        x = hash32((mul32(x & MASK32,0x9e3779b9) + self.s1) & MASK32)
+        x = hash32(x ^ self.s2)
+        return (x >> 8).to(torch.float32) * (1.0 / 2**24)
+
+    def uniform(self,shape,device,offset=0) -> torch.Tensor:
+        out = torch.empty(shape,dtype=torch.float32,device=device)
+        flat = out.view(-1)
+        chunk = cmn.chunk_size()
+        for start in range(0,flat.numel(),chunk):
+            cmn.check_stop()
+            count = min(chunk,flat.numel()-start)
+            flat[start:start+count] = self.uniform_range(offset+start,count,device)
+        return out
+
+    def bernoulli(self,p,offset=0) -> torch.Tensor:
+        return (self.uniform(p.shape,p.device,offset) < p).to(p.dtype)
+
+    def sample_indices(self,numel,p,device,offset=0) -> torch.Tensor:
+        #Flat indices kept at dropout rate p, where uniform() >= p, without materializing the full stream
+        indices = []
+        chunk = cmn.chunk_size()
+        for start in range(0,numel,chunk):
+            cmn.check_stop()
+            count = min(chunk,numel-start)
+            kept = torch.nonzero(self.uniform_range(offset+start,count,device) >= p).squeeze(1)
+            indices.append(kept + start)
+        if not indices:
+            return torch.empty(0,dtype=torch.int64,device=device)
+        return torch.cat(indices)
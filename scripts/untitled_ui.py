@@ -4,14 +4,15 @@ import re
 import functools
 import json
 import shutil
+import threading
 import torch
 import safetensors
 import safetensors.torch
 from modules import sd_models,script_callbacks,scripts,shared,ui_components,paths,sd_samplers,ui,call_queue
 from modules.ui_common import create_output_panel,plaintext_to_html, create_refresh_button
 # from modules.ui import create_sampler_and_steps_selection
-from scripts.untitled import merger,misc_util
-from scripts.untitled.operators import weights_cache
+from scripts.untitled import merger,misc_util,architectures,events,autotune,recipe
+from scripts.untitled.operators import weights_cache,read_cache
 import scripts.untitled.common as cmn
 
 extension_path = scripts.basedir()
@@ -62,6 +63,26 @@ class Progress:
         return '\n'.join(self.ui_report)
 
 
+class ProgressTracker:
+    #Forwards merge events to a gradio progress bar
+    def __init__(self,gr_progress):
+        self.gr_progress = gr_progress
+        self.total = 0
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def __call__(self,event):
+        if event['event'] == 'merge_started':
+            self.total = event['tasks']
+            self.done = 0
+            self.gr_progress((0,self.total),desc='Merging',unit='keys')
+        elif event['event'] == 'task_finished':
+            with self.lock:
+                self.done += 1
+                done = self.done
+            self.gr_progress((done,self.total),desc=event['key'],unit='keys')
+
+
 class Options:
     def __init__(self,filename):
         self.filename = filename
@@ -72,7 +93,7 @@ class Options:
             self.options = dict()
 
     def create_option(self,key,component,component_kwargs,default):
-        value = self.options.get(key) or default
+        value = self.options[key] if key in self.options else default #Saved False/0 values are kept
 
         opt_component = component(value = value,**component_kwargs)
         opt_component.do_not_save_to_config = True
@@ -84,10 +105,25 @@ class Options:
     def __getitem__(self,key):
         return self.options.get(key)
 
-    def save(self):
+    def save(self,notify=True):
         with open(self.filename,'w') as file:
             json.dump(self.options,file,indent=4)
-        gr.Info('Options saved')
+        if notify:
+            gr.Info('Options saved')
+
+    def save_key(self,key):
+        #Writes a single option, other values in the file keep what the user last saved
+        try:
+            with open(self.filename,'r') as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            saved = dict()
+        if key in self.options:
+            saved[key] = self.options[key]
+        else:
+            saved.pop(key,None)
+        with open(self.filename,'w') as file:
+            json.dump(saved,file,indent=4)
 
 cmn.opts = Options(options_filename)
 
@@ -136,8 +172,13 @@ def on_ui_tabs():
                         swap_models_AB.click(fn=swapvalues,inputs=[model_a,model_b],outputs=[model_a,model_b])
                         swap_models_BC.click(fn=swapvalues,inputs=[model_b,model_c],outputs=[model_b,model_c])
                         swap_models_CD.click(fn=swapvalues,inputs=[model_c,model_d],outputs=[model_c,model_d])
-                        refresh_button.click(fn=refresh_models,inputs=checkpoint_sort, outputs=[model_a,model_b,model_c,model_d])
-                        checkpoint_sort.change(fn=refresh_models,inputs=checkpoint_sort,outputs=[model_a,model_b,model_c,model_d])
+
+                    with gr.Row():
+                        extra_models = gr.Dropdown(get_checkpoints_list('Alphabetical'),multiselect=True,label='Additional models [N-way modes]',scale=3)
+                        model_weights = gr.Textbox(max_lines=1,label='Model weights',placeholder='1, 1, 0.5, ...',info='One per model in order, model_a is excluded for TIES and DARE. Missing weights are 1.',scale=1)
+
+                    refresh_button.click(fn=refresh_models,inputs=checkpoint_sort, outputs=[model_a,model_b,model_c,model_d,extra_models])
+                    checkpoint_sort.change(fn=refresh_models,inputs=checkpoint_sort,outputs=[model_a,model_b,model_c,model_d,extra_models])
 
 
                     #### MODE SELECTION
@@ -160,9 +201,10 @@ def on_ui_tabs():
                         with gr.Column(variant='panel'):
                             save_name = gr.Textbox(max_lines=1,label='Save checkpoint as:',lines=1,placeholder='Enter name...',scale=2)
                             with gr.Row():
-                                save_settings = gr.CheckboxGroup(label = " ",choices=["Autosave","Overwrite","fp16","bf16"],value=['fp16'],interactive=True,scale=2,min_width=100)
+                                save_settings = gr.CheckboxGroup(label = " ",choices=["Autosave","Overwrite","fp16","bf16","fp8"],value=['fp16'],interactive=True,scale=2,min_width=100,
+                                                                  info='fp8 keeps per-tensor scales in the file metadata. The webui loads it dequantized while this extension is enabled, other tools load the weights unscaled.')
                                 save_loaded = gr.Button(value='Save loaded checkpoint',size='sm',scale=1)
-                                save_loaded.click(fn=misc_util.save_loaded_model, inputs=[save_name,save_settings],outputs=status).then(fn=refresh_models, inputs=checkpoint_sort,outputs=[model_a,model_b,model_c,model_d])
+                                save_loaded.click(fn=misc_util.save_loaded_model, inputs=[save_name,save_settings],outputs=status).then(fn=refresh_models, inputs=checkpoint_sort,outputs=[model_a,model_b,model_c,model_d,extra_models])
             
                     #### MERGE BUTTONS
                         with gr.Column():
@@ -303,7 +345,7 @@ def on_ui_tabs():
             
                         cmn.opts.create_option('device',
                                             gr.Radio,
-                                            {'choices':['cuda/float16', 'cuda/float32', 'cpu/float32'],
+                                            {'choices':['cuda/float16', 'cuda/bfloat16', 'cuda/float32', 'cpu/bfloat16', 'cpu/float32'],
                                                 'label':'Preferred device/dtype for merging:'},
                                                 default='cuda/float16')
             
@@ -316,6 +358,80 @@ def on_ui_tabs():
                                                 'info':'Relevant for both cuda and CPU merging. Using too many threads can harm performance. Your core-count +-2 is a good guideline.'},
                                                 default=8)
             
+                        with gr.Row():
+                            cmn.opts.create_option('autotune',
+                                            gr.Checkbox,
+                                            {'label':'Auto-tune device, threads and chunk size',
+                                                'info':'Calibrates on a sample of keys the first time a calcmode is used on this machine, the profile is kept in the options file.'},
+                                                default=False)
+                            clear_profiles_button = gr.Button(value='Clear tuning profiles')
+                            clear_profiles_button.click(fn=autotune.clear_profiles,outputs=status)
+            
+                        cmn.opts.create_option('bulk_mode',
+                                            gr.Checkbox,
+                                            {'label':'Bulk mode: load whole models to VRAM',
+                                                'info':'Reads every model with a few large reads and merges Weight-Sum/Add Difference keys in groups. Only used with cuda when everything fits in free VRAM.'},
+                                                default=False)
+            
+                        cmn.opts.create_option('mmap_output',
+                                            gr.Checkbox,
+                                            {'label':'Write merges to disk and load them memory-mapped',
+                                                'info':'Unsaved merges go to a temp file in the webui data folder, saving the loaded model then only moves it.'},
+                                                default=False)
+            
+                        cmn.opts.create_option('hash_models',
+                                            gr.Checkbox,
+                                            {'label':'Hash input models',
+                                                'info':'sha256 of every input is computed in the background during the merge and stored in the merge recipe. Uses the webui hash cache, so checkpoints the webui already hashed are not read again.'},
+                                                default=True)
+
+                        with gr.Row():
+                            cmn.opts.create_option('reuse_merges',
+                                            gr.Slider,
+                                            {'step':1,
+                                                'minimum':0,
+                                                'maximum':8,
+                                                'label':'Merges kept for reuse:',
+                                                'info':'Keys whose recipe and inputs are unchanged are taken from these instead of merged again, even after the model was unloaded. 0 disables reuse.'},
+                                                default=2)
+                            cmn.opts.create_option('reuse_ram',
+                                            gr.Slider,
+                                            {'step':256,
+                                                'minimum':0,
+                                                'maximum':65536,
+                                                'label':'Reuse RAM (MB):',
+                                                'info':'Merges up to this size are kept in RAM, larger ones are memory-mapped from their autosave or temp file.'},
+                                                default=0)
+                            cmn.opts.create_option('reuse_spill',
+                                            gr.Checkbox,
+                                            {'label':'Spill merges for reuse to disk',
+                                                'info':'Merges that don\'t fit in RAM and have no output file are written to the webui data folder. Costs a full write of the model per merge.'},
+                                                default=False)
+
+                        cmn.opts.create_option('memory_budget',
+                                            gr.Slider,
+                                            {'step':256,
+                                                'minimum':0,
+                                                'maximum':65536,
+                                                'label':'In-flight memory budget (MB):',
+                                                'info':'Limits how many keys are merged at once by their estimated size. 0 uses half of the free memory on the merge device.'},
+                                                default=0)
+            
+                        cmn.opts.create_option('event_log',
+                                            gr.Checkbox,
+                                            {'label':'Write merge events to merge_events.jsonl',
+                                                'info':'One JSON line per task with key, bytes read, compute time, cache hits and memory high-water mark.'},
+                                                default=False)
+            
+                        read_cache_slider = cmn.opts.create_option('read_cache',
+                                            gr.Slider,
+                                            {'step':256,
+                                                'minimum':0,
+                                                'maximum':65536,
+                                                'label':'Read cache (MB):',
+                                                'info':'Keeps tensors read from input models mapped between merges, so consecutive merges sharing a model skip reading it again. Held as page cache, not copies.'},
+                                                default=4096)
+
                         cache_size_slider = cmn.opts.create_option('cache_size',
                                             gr.Slider,
                                             {'step':64,
@@ -327,6 +443,8 @@ def on_ui_tabs():
             
                     cache_size_slider.release(fn=lambda x: weights_cache.__init__(x),inputs=cache_size_slider)
                     weights_cache.__init__(cmn.opts['cache_size'])
+                    read_cache_slider.release(fn=lambda x: read_cache.__init__(x),inputs=read_cache_slider)
+                    read_cache.__init__(cmn.opts['read_cache'])
             
             
                 gen_elem_id = 'untitled_merger'
@@ -411,6 +529,14 @@ def on_ui_tabs():
                         target_tester = gr.Textbox(max_lines=1,label="Checks model_a keys using simple expression.",info="'*' is used as wildcard. Start expression with 'cond*' for clip. 'c*embedders.0*' for small clip. 'c*embedders.1*' for big clip. 'model.*' for unet and 'model_ema*' for ema unet",interactive=True,placeholder='model.*out*4*tran*norm*weight')
                         target_tester_display = gr.Textbox(max_lines=40,lines=40,label="Targeted keys:",info="",interactive=False)
                         target_tester.change(fn=test_regex,inputs=[target_tester],outputs=target_tester_display,show_progress='minimal')
+
+                    with gr.Accordion('Recipes',open=False):
+                        with gr.Row(equal_height=True):
+                            recipe_model = gr.Dropdown(get_checkpoints_list('Alphabetical'),label='Merged model',info='Empty uses the last merge',scale=2)
+                            recipe_other = gr.Dropdown(get_checkpoints_list('Alphabetical'),label='Compare with',info='Empty uses the last merge',scale=2)
+                            recipe_compare = gr.Button(value='Compare',scale=1)
+                        recipe_display = gr.Textbox(max_lines=20,lines=8,show_label=False,interactive=False)
+                        recipe_compare.click(fn=compare_recipes,inputs=[recipe_model,recipe_other],outputs=recipe_display)
             
                 merge_args = [
                     finetune,
@@ -419,6 +545,8 @@ def on_ui_tabs():
                     model_b,
                     model_c,
                     model_d,
+                    extra_models,
+                    model_weights,
                     alpha,
                     beta,
                     gamma,
@@ -479,7 +607,21 @@ def on_ui_tabs():
                 #                 inputs=gen_args,
                 #                 outputs=[output_gallery,infotext,output_html_log])
         with gr.Tab("LoRA", elem_id="tab_lora"):
-            dummy_component = gr.Textbox(visible=False,interactive=True)
+            with gr.Row():
+                with gr.Column():
+                    with gr.Row():
+                        lora_model_b = gr.Dropdown(get_checkpoints_list('Alphabetical'), label="Tuned model")
+                        lora_model_c = gr.Dropdown(get_checkpoints_list('Alphabetical'), label="Base model")
+                    with gr.Row():
+                        lora_rank = gr.Slider(minimum=1,maximum=256,step=1,value=32,label='Rank',info='Linear and 1x1 conv layers')
+                        lora_conv_rank = gr.Slider(minimum=0,maximum=128,step=1,value=0,label='Conv rank',info='3x3 conv layers, 0 skips them')
+                    with gr.Row(equal_height=True):
+                        lora_save_name = gr.Textbox(max_lines=1,label='Save LoRA as:',lines=1,placeholder='Enter name...',scale=2)
+                        lora_precision = gr.Radio(label='Precision',choices=['fp16','bf16','fp32'],value='fp16',scale=1)
+                        lora_extract_button = gr.Button(value='Extract LoRA',variant='primary',scale=1)
+                with gr.Column():
+                    lora_status = gr.Textbox(max_lines=4,lines=4,show_label=False,interactive=False)
+            lora_extract_button.click(fn=start_extract_lora,inputs=[lora_model_b,lora_model_c,lora_rank,lora_conv_rank,lora_save_name,lora_precision],outputs=lora_status)
 
 
     return [(cmn.blocks, "Untitled merger", "untitled_merger")]
@@ -487,35 +629,72 @@ def on_ui_tabs():
 script_callbacks.on_ui_tabs(on_ui_tabs)
 
 
-def start_merge(*args):
+def start_merge(gr_progress=gr.Progress(),*args):
     progress = Progress()
+    tracker = ProgressTracker(gr_progress)
+    events.subscribe(tracker)
 
     try:
         merger.prepare_merge(progress, *args)
     except Exception as error:
 
-        merger.clear_cache()
+        merger.release_merge()
         if not shared.sd_model:
             sd_models.reload_model_weights(forced_reload=True)
 
         if not isinstance(error,merger.MergeInterruptedError):
             raise
+    finally:
+        events.unsubscribe(tracker)
+
+    return progress.get_report()
+
+
+def start_extract_lora(model_b,model_c,rank,conv_rank,save_name,precision):
+    progress = Progress()
+    precision = {'fp16':torch.float16,'bf16':torch.bfloat16}.get(precision,torch.float32)
+
+    try:
+        merger.extract_lora(progress,model_b,model_c,int(rank),int(conv_rank),save_name,precision)
+    except merger.MergeInterruptedError:
+        pass
 
     return progress.get_report()
 
 
 def test_regex(input):
-    regex = misc_util.target_to_regex(input)
+    selectors = architectures.detect(model_a_keys).selectors if model_a_keys else None
+    regex = misc_util.target_to_regex(input,selectors)
     selected_keys = re.findall(regex,'\n'.join(model_a_keys),re.M)
     joined = '\n'.join(selected_keys)
     return  f'Matched keys: {len(selected_keys)}\n{joined}'
 
 
+def compare_recipes(model,other):
+    #Keys whose recipe differs between two merges, read from the sidecar or the embedded metadata
+    recipes = []
+    for name in (model,other):
+        if not name:
+            if cmn.last_merge_recipe is None:
+                return 'No merge recipe in this session'
+            recipes.append(cmn.last_merge_recipe)
+            continue
+        filename = misc_util.resolve_checkpoint(name)
+        loaded = recipe.load_file(filename) if filename else None
+        if loaded is None:
+            return 'No merge recipe found for '+name.split(' ')[0]
+        recipes.append(loaded)
+
+    differences = recipe.diff(*recipes)
+    lines = [f"{kind.title()}: {len(keys)}" for kind,keys in differences.items()]
+    for kind,keys in differences.items():
+        lines += [f'{kind} {key}' for key in keys]
+    return '\n'.join(lines)
+
+
 def update_model_a_keys(model_a):
     global model_a_keys
-    path = sd_models.get_closet_checkpoint_match(model_a).filename
-    with safetensors.torch.safe_open(path,framework='pt',device='cpu') as file:
-        model_a_keys = file.keys()
+    model_a_keys = architectures.probe(misc_util.resolve_checkpoint(model_a)).keys()
 
 
 def checkpoint_changed(name):
@@ -560,9 +739,9 @@ def calcmode_changed(calcmode_name):
 
 
 def get_checkpoints_list(sort):
-    checkpoints_list = [x.title for x in sd_models.checkpoints_list.values() if x.is_safetensors]
+    checkpoints_list = [x.title for x in sd_models.checkpoints_list.values() if x.is_safetensors] + misc_util.find_sharded_checkpoints()
     if sort == 'Newest first':
-        sort_func = lambda x: os.path.getctime(sd_models.get_closet_checkpoint_match(x).filename)
+        sort_func = lambda x: os.path.getctime(misc_util.resolve_checkpoint(x))
         checkpoints_list.sort(key=sort_func,reverse=True)
     return checkpoints_list
 
@@ -571,7 +750,7 @@ def refresh_models(sort):
     sd_models.list_models()
     checkpoints_list = get_checkpoints_list(sort)
 
-    return gr.update(choices=checkpoints_list),gr.update(choices=checkpoints_list),gr.update(choices=checkpoints_list),gr.update(choices=checkpoints_list)
+    return gr.update(choices=checkpoints_list),gr.update(choices=checkpoints_list),gr.update(choices=checkpoints_list),gr.update(choices=checkpoints_list),gr.update(choices=checkpoints_list)
 
 
 ### CUSTOM SLIDER FUNCS